@@ -324,9 +324,10 @@ def main(_):
 
       #raw_data = reader.ptb_raw_data(FLAGS.data_dir)
       #train_data, valid_data, test_data, _ = raw_data
-      train_data = reader.read_indexed_data(FLAGS.train_idx, FLAGS.max_train_data_size, config.vocab_size)
-      valid_data = reader.read_indexed_data(FLAGS.dev_idx, vocab_size=config.vocab_size)
-      test_data = reader.read_indexed_data(FLAGS.test_idx, vocab_size=config.vocab_size)
+      ids_dtype = reader.id_dtype(config.vocab_size)
+      train_data = reader.read_indexed_data(FLAGS.train_idx, FLAGS.max_train_data_size, config.vocab_size, ids_dtype)
+      valid_data = reader.read_indexed_data(FLAGS.dev_idx, vocab_size=config.vocab_size, dtype=ids_dtype)
+      test_data = reader.read_indexed_data(FLAGS.test_idx, vocab_size=config.vocab_size, dtype=ids_dtype)
 
       if FLAGS.use_adagrad:
         config.learning_rate = 0.5
@@ -368,10 +369,11 @@ def main(_):
         raw_data = reader.ptb_raw_data(FLAGS.data_dir)
         train_data, valid_data, test_data, _ = raw_data
       else:
-        train_data = reader.read_indexed_data(FLAGS.train_idx, FLAGS.max_train_data_size, config.vocab_size)
-        valid_data = reader.read_indexed_data(FLAGS.dev_idx, vocab_size=config.vocab_size)
+        ids_dtype = reader.id_dtype(config.vocab_size)
+        train_data = reader.read_indexed_data(FLAGS.train_idx, FLAGS.max_train_data_size, config.vocab_size, ids_dtype)
+        valid_data = reader.read_indexed_data(FLAGS.dev_idx, vocab_size=config.vocab_size, dtype=ids_dtype)
         if FLAGS.test_idx:
-          test_data = reader.read_indexed_data(FLAGS.test_idx, vocab_size=config.vocab_size)
+          test_data = reader.read_indexed_data(FLAGS.test_idx, vocab_size=config.vocab_size, dtype=ids_dtype)
 
       for epoch in range(start_epoch, config.max_max_epoch+1):
         if not (FLAGS.optimizer == "adadelta" or FLAGS.optimizer == "adam"):
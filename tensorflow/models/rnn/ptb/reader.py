@@ -20,32 +20,138 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import hashlib
+import logging
+import mmap
+from multiprocessing.pool import ThreadPool
 import os
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import tensorflow as tf
 
 
 def _read_words(filename):
+  """Yields the words of filename one at a time, with "<eos>" at line ends."""
   with tf.gfile.GFile(filename, "r") as f:
-    return f.read().replace("\n", "<eos>").split()
+    for line in f:
+      for word in line.split():
+        yield word
+      if line.endswith("\n"):
+        yield "<eos>"
+
+
+def _vocab_cache_path(filename):
+  """Returns where the vocabulary of filename is cached.
+
+  The cache name depends on the file's path, modification time and size, so
+  a changed training file never picks up a stale vocabulary.
+  """
+  key = "%s:%r:%d" % (os.path.abspath(filename), os.path.getmtime(filename),
+                      os.path.getsize(filename))
+  digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+  return os.path.join(os.path.dirname(filename), ".vocab_cache_%s" % digest)
+
+
+def _read_vocab_cache(cache_path):
+  """Returns the cached word list, or None if it is missing or incomplete.
+
+  The cache holds the number of words on its first line and then one word
+  per line, each ending in a newline; ids are implicit in the line order.
+  """
+  if not tf.gfile.Exists(cache_path):
+    return None
+  with tf.gfile.GFile(cache_path, "r") as f:
+    lines = tf.compat.as_str(f.read()).split("\n")
+  words = lines[1:-1]
+  try:
+    num_words = int(lines[0])
+  except ValueError:
+    return None
+  if lines[-1] or len(words) != num_words:
+    return None
+  return words
+
+
+def _write_vocab_cache(cache_path, words):
+  """Writes words to cache_path, replacing it atomically."""
+  tmp_path = "%s.tmp%d" % (cache_path, os.getpid())
+  try:
+    with tf.gfile.GFile(tmp_path, "w") as f:
+      f.write("%d\n" % len(words))
+      f.write("".join(word + "\n" for word in words))
+    tf.gfile.Rename(tmp_path, cache_path, overwrite=True)
+  except (IOError, OSError, tf.errors.OpError) as e:
+    logging.warning("Could not cache vocabulary to %s: %s", cache_path, e)
+    try:
+      tf.gfile.Remove(tmp_path)
+    except (IOError, OSError, tf.errors.OpError):
+      pass
 
 
 def _build_vocab(filename):
-  data = _read_words(filename)
+  cache_path = _vocab_cache_path(filename)
+  words = _read_vocab_cache(cache_path)
+  if words is not None:
+    return {word: i for i, word in enumerate(words)}
+
+  counter = collections.Counter(_read_words(filename))
+
+  words = np.array(list(counter.keys()))
+  counts = np.fromiter(counter.values(), dtype=np.int64, count=len(counter))
+  # Order by decreasing count, breaking ties alphabetically.
+  order = np.lexsort((words, -counts))
+  words = words[order].tolist()
+
+  _write_vocab_cache(cache_path, words)
+
+  return {word: i for i, word in enumerate(words)}
+
 
-  counter = collections.Counter(data)
-  count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
+def _files_to_word_ids(filenames, word_to_id):
+  """Converts each of filenames to an int32 array of word ids.
 
-  words, _ = list(zip(*count_pairs))
-  word_to_id = dict(zip(words, range(len(words))))
+  The vocabulary is fixed by now, so words are mapped all at once with a
+  binary search over one sorted copy of it, shared by all files. The files
+  are read on separate threads so that their I/O overlaps.
 
-  return word_to_id
+  Words are compared as UTF-8 bytes in fixed-width arrays, so every token of
+  a file takes as many bytes as the longest word in it (a quarter of what a
+  unicode array would need).
+
+  Raises:
+    KeyError: for the first word of a file that is not in word_to_id.
+  """
+  words = np.array([tf.compat.as_bytes(word) for word in word_to_id],
+                   dtype=np.bytes_)
+  ids = np.fromiter(word_to_id.values(), dtype=np.int32, count=len(word_to_id))
+  order = np.argsort(words)
+  words, ids = words[order], ids[order]
+
+  def to_ids(filename):
+    data = np.array([tf.compat.as_bytes(word)
+                     for word in _read_words(filename)], dtype=np.bytes_)
+    if not len(words):
+      # Nothing can match, and there is no last word to clip positions to.
+      if len(data):
+        raise KeyError(tf.compat.as_str(data[0]))
+      return ids
+    pos = np.minimum(np.searchsorted(words, data), len(words) - 1)
+    unknown = words[pos] != data
+    if unknown.any():
+      raise KeyError(tf.compat.as_str(data[unknown][0]))
+    return ids[pos]
+
+  pool = ThreadPool(len(filenames))
+  try:
+    return pool.map(to_ids, filenames)
+  finally:
+    pool.close()
+    pool.join()
 
 
 def _file_to_word_ids(filename, word_to_id):
-  data = _read_words(filename)
-  return [word_to_id[word] for word in data]
+  return _files_to_word_ids([filename], word_to_id)[0]
 
 
 def ptb_raw_data(data_dir=None):
@@ -64,7 +170,8 @@ def ptb_raw_data(data_dir=None):
 
   Returns:
     tuple (train_data, valid_data, test_data, vocabulary)
-    where each of the data objects can be passed to PTBIterator.
+    where each of the data objects is an int32 numpy array that can be passed
+    to ptb_iterator without being copied again.
   """
 
   train_path = os.path.join(data_dir, "ptb.train.txt")
@@ -72,27 +179,155 @@ def ptb_raw_data(data_dir=None):
   test_path = os.path.join(data_dir, "ptb.test.txt")
 
   word_to_id = _build_vocab(train_path)
-  train_data = _file_to_word_ids(train_path, word_to_id)
-  valid_data = _file_to_word_ids(valid_path, word_to_id)
-  test_data = _file_to_word_ids(test_path, word_to_id)
+  train_data, valid_data, test_data = _files_to_word_ids(
+      [train_path, valid_path, test_path], word_to_id)
   vocabulary = len(word_to_id)
   return train_data, valid_data, test_data, vocabulary
 
-def read_indexed_data(filename, max_train_data_size=0, vocab_size=None):
-  data = []
-  with tf.gfile.GFile(filename, "r") as f:
-    line_nr = 0
-    for line in f:
-      tok_ids = [ int(x) for x in line.split() ]
-      if vocab_size:
-        tok_ids = [ tok if tok < vocab_size else 0 for tok in tok_ids ] # 0 = UNK_ID
-      tok_ids.append(2) # EOS
-      data.extend(tok_ids)
-      line_nr += 1
-      if max_train_data_size > 0 and \
-        line_nr >= max_train_data_size:
-        break
-  return data
+# Place values of the digits of an id. Ids of up to 18 digits always fit in
+# an int64, far more than any vocabulary needs.
+_POWERS_OF_TEN = 10 ** np.arange(18, dtype=np.int64)
+
+
+def _read_bytes(filename):
+  """Returns the contents of filename as a uint8 array.
+
+  Local files are memory-mapped, so the array is backed by the page cache
+  rather than copied into a Python string. Other paths go through GFile.
+  """
+  if "://" in filename:
+    with tf.gfile.GFile(filename, "r") as f:
+      return np.frombuffer(tf.compat.as_bytes(f.read()), dtype=np.uint8)
+  with open(filename, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return np.zeros([0], dtype=np.uint8)
+    return np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),
+                         dtype=np.uint8)
+
+
+def id_dtype(vocab_size):
+  """Returns the narrowest numpy dtype that holds ids below vocab_size."""
+  if vocab_size and vocab_size <= np.iinfo(np.uint16).max + 1:
+    return np.uint16
+  return np.int32
+
+
+# read_indexed_data parses this many bytes at a time (rounded up to whole
+# lines), which bounds its per-byte temporaries independently of file size.
+_PARSE_CHUNK_BYTES = 2 << 20
+
+
+def _chunk_end(chars, start):
+  """Returns the end of the whole lines in about _PARSE_CHUNK_BYTES at start."""
+  size = _PARSE_CHUNK_BYTES
+  while start + size < len(chars):
+    line_ends = np.flatnonzero(chars[start:start + size] == ord("\n"))
+    if len(line_ends):
+      return start + int(line_ends[-1]) + 1
+    size *= 2  # A single line longer than the chunk.
+  return len(chars)
+
+
+def _parse_indexed_chunk(chars, line_ends, vocab_size, dtype, filename,
+                         first_line):
+  """Parses whole lines of ids in chars, given the positions of their ends.
+
+  first_line is the number of lines of filename before chars, for errors.
+  Returns the ids with an EOS (2) after every line.
+  """
+  def line_of(pos):
+    return first_line + int(np.searchsorted(line_ends, pos)) + 1
+
+  # An id spans a run of non-blank bytes; find where each run starts and ends.
+  is_space = (chars == ord(" ")) | ((chars >= ord("\t")) & (chars <= ord("\r")))
+  after_space = np.ones_like(is_space)
+  after_space[1:] = is_space[:-1]
+  before_space = np.ones_like(is_space)
+  before_space[:-1] = is_space[1:]
+  starts = np.flatnonzero(after_space & ~is_space).astype(np.int32)
+  ends = np.flatnonzero(before_space & ~is_space).astype(np.int32) + 1
+  del after_space, before_space
+
+  # Parse all ids at once straight from the bytes: every digit contributes
+  # digit * 10^(bytes left until the end of its id).
+  digit_pos = np.flatnonzero(~is_space).astype(np.int32)
+  del is_space
+  digits = chars[digit_pos] - ord("0")
+  if np.any(digits > 9):
+    raise ValueError("Non-numeric token on line %d of indexed data file %s"
+                     % (line_of(digit_pos[digits > 9][0]), filename))
+  data = np.zeros([len(starts)], dtype=np.int64)
+  if len(starts):
+    lengths = ends - starts
+    too_long = np.flatnonzero(lengths > len(_POWERS_OF_TEN))
+    if len(too_long):
+      raise ValueError("Id of more than %d digits on line %d of indexed data "
+                       "file %s" % (len(_POWERS_OF_TEN),
+                                    line_of(starts[too_long[0]]), filename))
+    places = np.repeat(ends, lengths)
+    places -= digit_pos
+    places -= 1
+    del digit_pos
+    values = _POWERS_OF_TEN[places]
+    del places
+    values *= digits
+    data = np.add.reduceat(values, np.cumsum(lengths) - lengths)
+  if vocab_size:
+    np.putmask(data, data >= vocab_size, 0) # 0 = UNK_ID
+
+  # Write ids and the EOS (2) closing each line straight into the result. An
+  # id moves right by the number of line ends before it, and a line's EOS
+  # goes after the ids that start before its end.
+  out = np.empty([len(starts) + len(line_ends)], dtype=dtype)
+  out[np.arange(len(starts)) + np.searchsorted(line_ends, starts)] = data
+  out[np.arange(len(line_ends)) + np.searchsorted(starts, line_ends)] = 2
+  return out
+
+
+def read_indexed_data(filename, max_train_data_size=0, vocab_size=None,
+                      dtype=np.int32):
+  """Reads a file of whitespace-separated word ids, one sentence per line.
+
+  The file is parsed in line-aligned chunks of a few MB, so peak memory is
+  the result plus a bounded amount of scratch space.
+
+  Args:
+    filename: path to the indexed data file.
+    max_train_data_size: if positive, only read this many lines.
+    vocab_size: if set, ids >= vocab_size are replaced by UNK_ID (0).
+    dtype: numpy dtype of the result, see id_dtype.
+
+  Returns:
+    numpy array of all ids, with EOS (2) after every line, which can be
+    passed to ptb_iterator without being copied again.
+
+  Raises:
+    ValueError: for a token that is not a number or has more than 18 digits.
+  """
+  chars = _read_bytes(filename)
+  lines_left = max_train_data_size if max_train_data_size > 0 else None
+  pieces = []
+  lines_read = 0
+  start = 0
+  while start < len(chars) and lines_left != 0:
+    end = _chunk_end(chars, start)
+    chunk = chars[start:end]
+    line_ends = np.flatnonzero(chunk == ord("\n")).astype(np.int32)
+    if lines_left is not None:
+      if len(line_ends) >= lines_left:
+        line_ends = line_ends[:lines_left]
+        chunk = chunk[:line_ends[-1] + 1]
+      lines_left -= len(line_ends)
+    if len(chunk) and chunk[-1] != ord("\n"):
+      line_ends = np.append(line_ends, np.int32(len(chunk)))
+    pieces.append(_parse_indexed_chunk(chunk, line_ends, vocab_size, dtype,
+                                       filename, lines_read))
+    lines_read += len(line_ends)
+    start = end
+  if not pieces:
+    return np.empty([0], dtype=dtype)
+  return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
 
 def ptb_iterator(raw_data, batch_size, num_steps, start_idx=0):
   """Iterate on the raw PTB data.
@@ -101,32 +336,89 @@ def ptb_iterator(raw_data, batch_size, num_steps, start_idx=0):
   minibatch iteration along these pointers.
 
   Args:
-    raw_data: one of the raw data outputs from ptb_raw_data.
+    raw_data: one of the raw data outputs from ptb_raw_data. A numpy array
+      is used in place, keeping its dtype; anything else is converted to an
+      int32 array once.
     batch_size: int, the batch size.
     num_steps: int, the number of unrolls.
+    start_idx: int, index of the first batch to yield.
 
   Yields:
     Pairs of the batched data, each a matrix of shape [batch_size, num_steps].
     The second element of the tuple is the same data time-shifted to the
-    right by one.
+    right by one. Both are read-only views into raw_data rather than copies,
+    so they change if raw_data does; copy them to modify or keep them.
 
   Raises:
     ValueError: if batch_size or num_steps are too high.
   """
-  raw_data = np.array(raw_data, dtype=np.int32)
+  if not isinstance(raw_data, np.ndarray):
+    raw_data = np.asarray(raw_data, dtype=np.int32)
 
   data_len = len(raw_data)
   batch_len = data_len // batch_size
-  data = np.zeros([batch_size, batch_len], dtype=np.int32)
-  for i in range(batch_size):
-    data[i] = raw_data[batch_len * i:batch_len * (i + 1)]
+  # Row i holds raw_data[batch_len * i:batch_len * (i + 1)]; a reshape of the
+  # truncated contiguous buffer gives the same layout without a copy.
+  data = raw_data[:batch_size * batch_len].reshape([batch_size, batch_len])
 
   epoch_size = (batch_len - 1) // num_steps
 
   if epoch_size == 0:
     raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
 
+  # Consecutive batches are windows of fixed stride num_steps over each row, so
+  # lay out the whole epoch as [epoch_size, batch_size, num_steps] views of
+  # data and hand out slices of those instead of re-slicing on every step.
+  row_stride, col_stride = data.strides
+  shape = [epoch_size, batch_size, num_steps]
+  strides = [num_steps * col_stride, row_stride, col_stride]
+  xs = as_strided(data, shape=shape, strides=strides)
+  ys = as_strided(data[:, 1:], shape=shape, strides=strides)
+  # The windows overlap and alias raw_data, so writing through one would
+  # corrupt other batches and the caller's array.
+  xs.flags.writeable = False
+  ys.flags.writeable = False
+
   for i in range(start_idx, epoch_size):
-    x = data[:, i*num_steps:(i+1)*num_steps]
-    y = data[:, i*num_steps+1:(i+1)*num_steps+1]
-    yield (x, y)
+    yield (xs[i], ys[i])
+
+
+def ptb_producer(raw_data, batch_size, num_steps, name=None):
+  """Iterate on the raw PTB data inside the TensorFlow runtime.
+
+  This chunks up raw_data into batches of examples like ptb_iterator, but the
+  slicing happens in the graph and batch indices are fed by a queue runner,
+  so batches are produced without a Python loop on the critical path.
+
+  Args:
+    raw_data: one of the raw data outputs from ptb_raw_data.
+    batch_size: int, the batch size.
+    num_steps: int, the number of unrolls.
+    name: the name of this operation (optional).
+
+  Returns:
+    A pair of Tensors, each shaped [batch_size, num_steps]. The second element
+    of the tuple is the same data time-shifted to the right by one.
+
+  Raises:
+    tf.errors.InvalidArgumentError: if batch_size or num_steps are too high.
+  """
+  with tf.name_scope(name, "PTBProducer", [raw_data, batch_size, num_steps]):
+    raw_data = tf.convert_to_tensor(raw_data, name="raw_data", dtype=tf.int32)
+
+    data_len = tf.size(raw_data)
+    batch_len = data_len // batch_size
+    data = tf.reshape(tf.slice(raw_data, [0], [batch_size * batch_len]),
+                      [batch_size, batch_len])
+
+    epoch_size = (batch_len - 1) // num_steps
+    assertion = tf.assert_positive(
+        epoch_size,
+        message="epoch_size == 0, decrease batch_size or num_steps")
+    with tf.control_dependencies([assertion]):
+      epoch_size = tf.identity(epoch_size, name="epoch_size")
+
+    i = tf.train.range_input_producer(epoch_size, shuffle=False).dequeue()
+    x = tf.slice(data, tf.pack([0, i * num_steps]), [batch_size, num_steps])
+    y = tf.slice(data, tf.pack([0, i * num_steps + 1]), [batch_size, num_steps])
+    return x, y
@@ -44,6 +44,93 @@ class PtbReaderTest(tf.test.TestCase):
     output = reader.ptb_raw_data(tmpdir)
     self.assertEqual(len(output), 4)
 
+  def testBuildVocabCache(self):
+    tmpdir = tf.test.get_temp_dir()
+    empty = os.path.join(tmpdir, "empty_vocab.txt")
+    with tf.gfile.GFile(empty, "w") as fh:
+      fh.write("")
+    self.assertEqual(reader._build_vocab(empty), {})
+    self.assertEqual(reader._build_vocab(empty), {})
+
+    filename = os.path.join(tmpdir, "vocab.txt")
+    with tf.gfile.GFile(filename, "w") as fh:
+      fh.write(self._string_data)
+    word_to_id = reader._build_vocab(filename)
+    self.assertEqual(reader._build_vocab(filename), word_to_id)
+    # A truncated cache is ignored and rewritten.
+    cache_path = reader._vocab_cache_path(filename)
+    with tf.gfile.GFile(cache_path, "w") as fh:
+      fh.write("%d\n<eos>\n" % len(word_to_id))
+    self.assertEqual(reader._build_vocab(filename), word_to_id)
+    self.assertEqual(reader._build_vocab(filename), word_to_id)
+
+  def testFilesToWordIds(self):
+    filename = os.path.join(tf.test.get_temp_dir(), "word_ids.txt")
+    with tf.gfile.GFile(filename, "w") as fh:
+      fh.write("a bb\nccc a\n")
+    word_to_id = {"<eos>": 0, "a": 1, "bb": 2, "ccc": 3}
+    ids, = reader._files_to_word_ids([filename], word_to_id)
+    self.assertAllEqual(ids, [1, 2, 0, 3, 1, 0])
+    with self.assertRaisesRegexp(KeyError, "ccc"):
+      reader._files_to_word_ids([filename], {"<eos>": 0, "a": 1, "bb": 2})
+    with self.assertRaisesRegexp(KeyError, "a"):
+      reader._files_to_word_ids([filename], {})
+
+  def testReadIndexedData(self):
+    filename = os.path.join(tf.test.get_temp_dir(), "indexed.txt")
+    with tf.gfile.GFile(filename, "w") as fh:
+      fh.write("4 17 5\n\n9 3\n")
+    self.assertAllEqual(reader.read_indexed_data(filename),
+                        [4, 17, 5, 2, 2, 9, 3, 2])
+    self.assertAllEqual(reader.read_indexed_data(filename, vocab_size=10),
+                        [4, 0, 5, 2, 2, 9, 3, 2])
+    self.assertAllEqual(reader.read_indexed_data(filename, 2, vocab_size=10),
+                        [4, 0, 5, 2, 2])
+
+  def testReadIndexedDataInChunks(self):
+    filename = os.path.join(tf.test.get_temp_dir(), "indexed_chunks.txt")
+    with tf.gfile.GFile(filename, "w") as fh:
+      fh.write("4 17 5\n\n9 3\n123456 8 \n7")
+    expected = [4, 17, 5, 2, 2, 9, 3, 2, 123456, 8, 2, 7, 2]
+    chunk_bytes = reader._PARSE_CHUNK_BYTES
+    try:
+      # Smaller than some lines, so chunks have to grow to a line end.
+      reader._PARSE_CHUNK_BYTES = 5
+      self.assertAllEqual(reader.read_indexed_data(filename), expected)
+      self.assertAllEqual(reader.read_indexed_data(filename, 3),
+                          expected[:8])
+
+      # Errors name the line in the file, not in the chunk.
+      with tf.gfile.GFile(filename, "w") as fh:
+        fh.write("1 2\n3\n4 %s\n" % ("9" * 19))
+      with self.assertRaisesRegexp(ValueError, "18 digits on line 3"):
+        reader.read_indexed_data(filename)
+      with tf.gfile.GFile(filename, "w") as fh:
+        fh.write("1 2\n3 x\n")
+      with self.assertRaisesRegexp(ValueError, "Non-numeric token on line 2"):
+        reader.read_indexed_data(filename)
+    finally:
+      reader._PARSE_CHUNK_BYTES = chunk_bytes
+
+  def testPtbIterator(self):
+    raw_data = [4, 3, 2, 1, 0, 5, 6, 1, 1, 1, 1, 0, 3, 4, 1]
+    batch_size = 3
+    num_steps = 2
+    output = list(reader.ptb_iterator(raw_data, batch_size, num_steps))
+    self.assertEqual(len(output), 2)
+    o1, o2 = (output[0], output[1])
+    self.assertEqual(o1[0].shape, (batch_size, num_steps))
+    self.assertEqual(o1[1].shape, (batch_size, num_steps))
+    self.assertEqual(o2[0].shape, (batch_size, num_steps))
+    self.assertEqual(o2[1].shape, (batch_size, num_steps))
+    self.assertAllEqual(o1[0], [[4, 3], [5, 6], [1, 0]])
+    self.assertAllEqual(o1[1], [[3, 2], [6, 1], [0, 3]])
+    self.assertAllEqual(o2[0], [[2, 1], [1, 1], [3, 4]])
+    self.assertAllEqual(o2[1], [[1, 0], [1, 1], [4, 1]])
+    for x, y in output:
+      self.assertFalse(x.flags.writeable)
+      self.assertFalse(y.flags.writeable)
+
   def testPtbProducer(self):
     raw_data = [4, 3, 2, 1, 0, 5, 6, 1, 1, 1, 1, 0, 3, 4, 1]
     batch_size = 3
@@ -1,118 +1,71 @@
+import os
 import re
 import logging
+import weakref
 import tensorflow as tf
 
 from tensorflow.models.rnn.ptb.rnnlm import RNNLMModel
 
-class SmallConfig(object):
-  """Small config."""
-  init_scale = 0.1
-  learning_rate = 1.0
-  max_grad_norm = 5
-  num_layers = 2
-  num_steps = 20
-  hidden_size = 200
-  max_epoch = 4
-  max_max_epoch = 13
-  keep_prob = 1.0
-  lr_decay = 0.5
-  batch_size = 20
-  vocab_size = 10000
-
-class MediumConfig(object):
-  """Medium config."""
-  init_scale = 0.05
-  learning_rate = 1.0
-  max_grad_norm = 5
-  num_layers = 2
-  num_steps = 35
-  hidden_size = 650
-  max_epoch = 6
-  max_max_epoch = 39
-  keep_prob = 0.5
-  lr_decay = 0.8
-  batch_size = 20
-  vocab_size = 10000
-
-class MediumConfig16k(object):
-  """Medium config."""
-  init_scale = 0.05
-  learning_rate = 1.0
-  max_grad_norm = 5
-  num_layers = 2
-  num_steps = 35
-  hidden_size = 650
-  max_epoch = 6
-  max_max_epoch = 39
-  keep_prob = 0.5
-  lr_decay = 0.8
-  batch_size = 20
-  vocab_size = 16162
-
-class LargeConfig(object):
-  """Large config."""
-  init_scale = 0.04
-  learning_rate = 1.0
-  max_grad_norm = 10
-  num_layers = 2
-  num_steps = 35
-  hidden_size = 1500
-  max_epoch = 14
-  max_max_epoch = 55
-  keep_prob = 0.35
-  lr_decay = 1 / 1.15
-  batch_size = 20
-  vocab_size = 10000
-
-class LargeConfig50k(object):
-  """Large config."""
-  init_scale = 0.04
-  learning_rate = 1.0
-  max_grad_norm = 10
-  num_layers = 2
-  num_steps = 35
-  hidden_size = 1500
-  max_epoch = 14
-  max_max_epoch = 55
-  keep_prob = 0.35
-  lr_decay = 1 / 1.15
-  batch_size = 80
-  vocab_size = 50003
-
-class TestConfig(object):
-  """Tiny config, for testing."""
-  init_scale = 0.1
-  learning_rate = 1.0
-  max_grad_norm = 1
-  num_layers = 1
-  num_steps = 2
-  hidden_size = 2
-  max_epoch = 1
-  max_max_epoch = 1
-  keep_prob = 1.0
-  lr_decay = 0.5
-  batch_size = 20
-  vocab_size = 10000
+# Config values made of digits are ints (group 1), digits and dots floats.
+_NUMBER_RE = re.compile(r"^(?:(\d+)|[\d\.]+)$")
+
+# Models built by create_model and load_model, see _session_models.
+_models_by_session = weakref.WeakKeyDictionary()
+
+class Config(object):
+  """Model hyperparameters, see ptb_word_lm.py for their meaning."""
+
+  def __init__(self, init_scale, learning_rate, max_grad_norm, num_layers,
+               num_steps, hidden_size, max_epoch, max_max_epoch, keep_prob,
+               lr_decay, batch_size, vocab_size):
+    self.init_scale = init_scale
+    self.learning_rate = learning_rate
+    self.max_grad_norm = max_grad_norm
+    self.num_layers = num_layers
+    self.num_steps = num_steps
+    self.hidden_size = hidden_size
+    self.max_epoch = max_epoch
+    self.max_max_epoch = max_max_epoch
+    self.keep_prob = keep_prob
+    self.lr_decay = lr_decay
+    self.batch_size = batch_size
+    self.vocab_size = vocab_size
+
+_SMALL = dict(init_scale=0.1, learning_rate=1.0, max_grad_norm=5,
+              num_layers=2, num_steps=20, hidden_size=200, max_epoch=4,
+              max_max_epoch=13, keep_prob=1.0, lr_decay=0.5, batch_size=20,
+              vocab_size=10000)
+_MEDIUM = dict(init_scale=0.05, learning_rate=1.0, max_grad_norm=5,
+               num_layers=2, num_steps=35, hidden_size=650, max_epoch=6,
+               max_max_epoch=39, keep_prob=0.5, lr_decay=0.8, batch_size=20,
+               vocab_size=10000)
+_LARGE = dict(init_scale=0.04, learning_rate=1.0, max_grad_norm=10,
+              num_layers=2, num_steps=35, hidden_size=1500, max_epoch=14,
+              max_max_epoch=55, keep_prob=0.35, lr_decay=1 / 1.15,
+              batch_size=20, vocab_size=10000)
+
+# Keyword arguments of Config for each named model. get_config builds a new
+# Config on every call, so callers may change fields such as batch_size.
+_CONFIGS = {
+    "small": _SMALL,
+    "medium": _MEDIUM,
+    "medium16k": dict(_MEDIUM, vocab_size=16162),
+    "large": _LARGE,
+    "large50k": dict(_LARGE, batch_size=80, vocab_size=50003),
+    "test": dict(init_scale=0.1, learning_rate=1.0, max_grad_norm=1,
+                 num_layers=1, num_steps=2, hidden_size=2, max_epoch=1,
+                 max_max_epoch=1, keep_prob=1.0, lr_decay=0.5, batch_size=20,
+                 vocab_size=10000),
+}
 
 def get_config(model_config):
-  if model_config == "small":
-    return SmallConfig()
-  elif model_config == "medium":
-    return MediumConfig()
-  elif model_config == "medium16k":
-    return MediumConfig16k()
-  elif model_config == "large":
-    return LargeConfig()
-  elif model_config == "large50k":
-    return LargeConfig50k()
-  elif model_config == "test":
-    return TestConfig()
-  else:
-    raise ValueError("Invalid model: %s", model_config)
+  if model_config not in _CONFIGS:
+    raise ValueError("Invalid model: %s" % model_config)
+  return Config(**_CONFIGS[model_config])
 
 def read_config(config_file):
-  # Use MediumConfig as default
-  config = MediumConfig()
+  # Use the medium config as default
+  config = get_config("medium")
   logging.info("Settings from tensorflow config file:")  
   with open(config_file) as f:
     for line in f:
@@ -121,48 +74,70 @@ def read_config(config_file):
       else:
         key, value = line.strip().split(":")
       key,value = key.strip(), value.strip()
-      if re.match("^\d+$", value):
-        value = int(value)
-      elif re.match("^[\d\.]+$", value):
-        value = float(value)
+      number = _NUMBER_RE.match(value)
+      if number:
+        value = int(value) if number.group(1) else float(value)
       config.key = value
       logging.info("{}: {}".format(key, value))
   return config
 
-def create_model(session, config, eval_config, train_dir, optimizer, variable_prefix="model"):
-  initializer = tf.random_uniform_initializer(-config.init_scale, config.init_scale)
-  with tf.variable_scope(variable_prefix, reuse=None, initializer=initializer):
-    model = RNNLMModel(config, variable_prefix, is_training=True, optimizer=optimizer)
-  with tf.variable_scope(variable_prefix, reuse=True, initializer=initializer):
-    mvalid = RNNLMModel(config, variable_prefix, is_training=False)
-    mtest = RNNLMModel(eval_config, variable_prefix, is_training=False)
+def _session_models(session):
+  """Returns the dict of models already built in session, keyed by call args.
+
+  Building a model again in the same session would try to create its
+  variables a second time, so create_model and load_model hand back the
+  model from their earlier call instead.
+  """
+  return _models_by_session.setdefault(session, {})
+
+def _checkpoint_stamp(model_path):
+  """Returns (model_path, mtime), which changes whenever the checkpoint does.
 
+  Uses tf.gfile.Stat rather than os.path.getmtime so that remote paths such
+  as gs:// work too.
+  """
+  return model_path, tf.gfile.Stat(model_path).mtime_nsec
+
+def create_model(session, config, eval_config, train_dir, optimizer, variable_prefix="model"):
   ckpt = tf.train.get_checkpoint_state(train_dir)
   if ckpt and tf.gfile.Exists(ckpt.model_checkpoint_path):
-    logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-    model.saver.restore(session, ckpt.model_checkpoint_path)
+    checkpoint = _checkpoint_stamp(ckpt.model_checkpoint_path)
+  else:
+    checkpoint = None
+
+  models = _session_models(session)
+  key = ("create", variable_prefix, train_dir)
+  args = (config, eval_config, optimizer)
+  if key in models:
+    built, built_args, loaded_checkpoint = models[key]
+    if any(arg is not built_arg for arg, built_arg in zip(args, built_args)):
+      raise ValueError("Model %s in %s was already created in this session "
+                       "with a different config, eval_config or optimizer."
+                       % (variable_prefix, train_dir))
+    if checkpoint is None or checkpoint == loaded_checkpoint:
+      return built
+  else:
+    initializer = tf.random_uniform_initializer(-config.init_scale, config.init_scale)
+    with tf.variable_scope(variable_prefix, reuse=None, initializer=initializer):
+      model = RNNLMModel(config, variable_prefix, is_training=True, optimizer=optimizer)
+    with tf.variable_scope(variable_prefix, reuse=True, initializer=initializer):
+      mvalid = RNNLMModel(config, variable_prefix, is_training=False)
+      mtest = RNNLMModel(eval_config, variable_prefix, is_training=False)
+    built = model, mvalid, mtest
+
+  if checkpoint:
+    logging.info("Reading model parameters from %s" % checkpoint[0])
+    built[0].saver.restore(session, checkpoint[0])
   else:
     logging.info("Created model with fresh parameters.")
     session.run(tf.initialize_all_variables())
-  return model, mvalid, mtest
+  models[key] = built, args, checkpoint
+  return built
 
 def load_model(session, model_config, path, use_log_probs=False,
                variable_prefix="model", rename_variable_prefix=None):
   # Create and load model for decoding
-  # If model_config is a path, read config from that path, else treat as config name
-  if os.path.exists(model_config):
-    config = read_config(model_config)
-  else:
-    config = get_config(model_config)
-  config.batch_size = 1
-  config.num_steps = 1
-
-  with tf.variable_scope(variable_prefix, reuse=None):
-    model = RNNLMModel(config, variable_prefix, is_training=False,
-                       use_log_probs=use_log_probs,
-                       rename_variable_prefix=rename_variable_prefix)
-
-  if os.path.isdir(path):
+  if tf.gfile.IsDirectory(path):
     ckpt = tf.train.get_checkpoint_state(path)
     if ckpt and tf.gfile.Exists(ckpt.model_checkpoint_path):
       model_path = ckpt.model_checkpoint_path
@@ -174,9 +149,32 @@ def load_model(session, model_config, path, use_log_probs=False,
   else:
     logging.error("Could not load model %s." % path)
     exit(1)
+  checkpoint = _checkpoint_stamp(model_path)
+
+  models = _session_models(session)
+  key = ("load", model_config, path, use_log_probs, variable_prefix,
+         rename_variable_prefix)
+  if key in models:
+    model, config, loaded_checkpoint = models[key]
+    if loaded_checkpoint == checkpoint:
+      return model, config
+  else:
+    # If model_config is a path, read config from that path, else treat as config name
+    if os.path.exists(model_config):
+      config = read_config(model_config)
+    else:
+      config = get_config(model_config)
+    config.batch_size = 1
+    config.num_steps = 1
+
+    with tf.variable_scope(variable_prefix, reuse=None):
+      model = RNNLMModel(config, variable_prefix, is_training=False,
+                         use_log_probs=use_log_probs,
+                         rename_variable_prefix=rename_variable_prefix)
 
   logging.info("Reading model parameters from %s" % model_path)
   model.saver.restore(session, model_path)
+  models[key] = model, config, checkpoint
   return model, config
 
 def rename_variable_prefix(session, model_config, model_path, new_model_path,
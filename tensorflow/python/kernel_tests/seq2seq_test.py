@@ -45,6 +45,26 @@ class Seq2SeqTest(tf.test.TestCase):
         res = sess.run([mem])
         self.assertEqual((2, 2), res[0].shape)
 
+  def testDynamicRNNDecoder(self):
+    with self.test_session() as sess:
+      with tf.variable_scope("root", initializer=tf.constant_initializer(0.5)):
+        inp = [tf.constant(0.5, shape=[2, 2])] * 2
+        _, enc_state = tf.nn.rnn(
+            tf.nn.rnn_cell.GRUCell(2), inp, dtype=tf.float32)
+        dec_inp = [tf.constant(0.4, shape=[2, 2]),
+                   tf.constant(0.3, shape=[2, 2]),
+                   tf.constant(0.2, shape=[2, 2])]
+        cell = tf.nn.rnn_cell.GRUCell(2)
+        dec, mem = tf.nn.seq2seq.rnn_decoder(dec_inp, enc_state, cell)
+        dyn_dec, dyn_mem = tf.nn.seq2seq.dynamic_rnn_decoder(
+            dec_inp, enc_state, cell)
+        self.assertEqual([3, 2, 2], dyn_dec.get_shape().as_list())
+        sess.run([tf.global_variables_initializer()])
+        res, dyn_res = sess.run([dec, dyn_dec])
+        self.assertAllClose(res, dyn_res)
+        res, dyn_res = sess.run([mem, dyn_mem])
+        self.assertAllClose(res, dyn_res)
+
   def testBasicRNNSeq2Seq(self):
     with self.test_session() as sess:
       with tf.variable_scope("root", initializer=tf.constant_initializer(0.5)):
@@ -61,6 +81,21 @@ class Seq2SeqTest(tf.test.TestCase):
         res = sess.run([mem])
         self.assertEqual((2, 2), res[0].shape)
 
+  def testBasicRNNSeq2SeqDynamicEncoder(self):
+    with self.test_session() as sess:
+      with tf.variable_scope("root", initializer=tf.constant_initializer(0.5)):
+        inp = [tf.constant(0.5, shape=[2, 2]), tf.constant(0.2, shape=[2, 2])]
+        dec_inp = [tf.constant(0.4, shape=[2, 2])] * 3
+        cell = tf.nn.rnn_cell.OutputProjectionWrapper(
+            tf.nn.rnn_cell.GRUCell(2), 4)
+        dec, mem = tf.nn.seq2seq.basic_rnn_seq2seq(
+            inp, dec_inp, cell, scope="static")
+        dyn_dec, dyn_mem = tf.nn.seq2seq.basic_rnn_seq2seq(
+            inp, dec_inp, cell, scope="dynamic", use_dynamic_rnn=True)
+        sess.run([tf.global_variables_initializer()])
+        self.assertAllClose(sess.run(dec), sess.run(dyn_dec))
+        self.assertAllClose(sess.run(mem), sess.run(dyn_mem))
+
   def testTiedRNNSeq2Seq(self):
     with self.test_session() as sess:
       with tf.variable_scope("root", initializer=tf.constant_initializer(0.5)):
@@ -97,6 +132,52 @@ class Seq2SeqTest(tf.test.TestCase):
         self.assertEqual((2, 2), res[0].c.shape)
         self.assertEqual((2, 2), res[0].h.shape)
 
+        # Test with the decoder inputs packed into one [time, batch] tensor.
+        tf.get_variable_scope().reuse_variables()
+        packed_dec, _ = tf.nn.seq2seq.embedding_rnn_decoder(
+            tf.pack(dec_inp), enc_state, cell, num_symbols=4,
+            embedding_size=2)
+        self.assertAllClose(sess.run(dec), sess.run(packed_dec))
+
+  def testEmbeddingRNNDecoderPartitioned(self):
+    with self.test_session() as sess:
+      dec_inp = [tf.constant([i, 5 - i], tf.int32) for i in range(3)]
+      outputs = {}
+      for name, partitioner in (("plain", None),
+                                ("sharded", tf.fixed_size_partitioner(2))):
+        with tf.variable_scope(name,
+                               initializer=tf.constant_initializer(0.5)):
+          cell = tf.nn.rnn_cell.BasicLSTMCell(2, state_is_tuple=True)
+          init_state = cell.zero_state(2, tf.float32)
+          for feed_previous in False, True:
+            dec, _ = tf.nn.seq2seq.embedding_rnn_decoder(
+                dec_inp, init_state, cell, num_symbols=6, embedding_size=2,
+                feed_previous=feed_previous,
+                embedding_partitioner=partitioner)
+            outputs[name, feed_previous] = dec
+            tf.get_variable_scope().reuse_variables()
+
+      def embedding_vars(name):
+        prefix = name + "/embedding_rnn_decoder/embedding"
+        return sorted((v for v in tf.global_variables()
+                       if v.op.name.startswith(prefix)),
+                      key=lambda v: v.op.name)
+      plain, sharded = embedding_vars("plain"), embedding_vars("sharded")
+      self.assertEqual(1, len(plain))
+      self.assertEqual(2, len(sharded))
+      self.assertEqual([3, 2], sharded[0].get_shape().as_list())
+
+      # Give both tables the same distinct rows; "div" puts rows 0-2 in the
+      # first shard and rows 3-5 in the second.
+      emb_val = np.arange(12, dtype=np.float32).reshape([6, 2]) / 12.0
+      sess.run(tf.global_variables_initializer())
+      sess.run([plain[0].assign(emb_val), sharded[0].assign(emb_val[:3]),
+                sharded[1].assign(emb_val[3:])])
+      for feed_previous in False, True:
+        plain_res, sharded_res = sess.run([outputs["plain", feed_previous],
+                                           outputs["sharded", feed_previous]])
+        self.assertAllClose(plain_res, sharded_res)
+
   def testEmbeddingRNNSeq2Seq(self):
     with self.test_session() as sess:
       with tf.variable_scope("root", initializer=tf.constant_initializer(0.5)):
@@ -242,6 +323,29 @@ class Seq2SeqTest(tf.test.TestCase):
         res = sess.run([mem])
         self.assertEqual((2, 2), res[0].shape)
 
+  def testAttentionDecoderWhileLoop(self):
+    with self.test_session() as sess:
+      with tf.variable_scope("root", initializer=tf.constant_initializer(0.5)):
+        cell = tf.nn.rnn_cell.GRUCell(2)
+        inp = [tf.constant(0.5, shape=[2, 2])] * 2
+        enc_outputs, enc_state = tf.nn.rnn(cell, inp, dtype=tf.float32)
+        attn_states = tf.concat(1, [tf.reshape(e, [-1, 1, cell.output_size])
+                                    for e in enc_outputs])
+        dec_inp = [tf.constant(0.4, shape=[2, 2]),
+                   tf.constant(0.3, shape=[2, 2]),
+                   tf.constant(0.2, shape=[2, 2])]
+        dec, mem = tf.nn.seq2seq.attention_decoder(
+            dec_inp, enc_state, attn_states, cell, output_size=4,
+            scope="unrolled")
+        loop_dec, loop_mem = tf.nn.seq2seq.attention_decoder(
+            dec_inp, enc_state, attn_states, cell, output_size=4,
+            scope="while_loop", use_while_loop=True)
+        sess.run([tf.global_variables_initializer()])
+        res, loop_res = sess.run([dec, loop_dec])
+        self.assertEqual(3, len(loop_res))
+        self.assertAllClose(res, loop_res)
+        self.assertAllClose(sess.run(mem), sess.run(loop_mem))
+
   def testAttentionDecoder2(self):
     with self.test_session() as sess:
       with tf.variable_scope("root", initializer=tf.constant_initializer(0.5)):
@@ -540,6 +644,82 @@ class Seq2SeqTest(tf.test.TestCase):
       res = sess.run(loss_per_sequence)
       self.assertAllClose(np.asarray([4.828314, 4.828314]), res)
 
+      weights[1] = tf.constant([1.0, 0.0])
+      loss_per_sequence, total_size = tf.nn.seq2seq.sequence_loss_by_example(
+          logits, targets, weights,
+          average_across_timesteps=False, return_total_size=True)
+      res, size = sess.run([loss_per_sequence, total_size])
+      self.assertAllClose(np.asarray([4.828314, 3.218876]), res)
+      self.assertAllClose(np.asarray([3.0, 2.0]), size)
+
+      loss, total_size = tf.nn.seq2seq.sequence_loss(
+          logits, targets, weights, return_total_size=True)
+      res, size = sess.run([loss, total_size])
+      self.assertAllClose(1.609438, res)
+      self.assertAllClose(np.asarray([3.0, 2.0]), size)
+
+  def testSequenceLossByExampleSampled(self):
+    with self.test_session() as sess:
+      output_classes = 10
+      output_size = 4
+      rng = np.random.RandomState(0)
+      w_t_val = rng.randn(output_classes, output_size).astype(np.float32)
+      b_val = rng.randn(output_classes).astype(np.float32)
+      output_vals = [rng.randn(2, output_size).astype(np.float32)
+                     for _ in range(3)]
+      target_vals = [np.array([i, i + 3], dtype=np.int32) for i in range(3)]
+      weight_vals = [np.array([1.0, 0.5], dtype=np.float32) for _ in range(3)]
+
+      loss_per_sequence = tf.nn.seq2seq.sequence_loss_by_example(
+          [tf.constant(o) for o in output_vals],
+          [tf.constant(t) for t in target_vals],
+          [tf.constant(w) for w in weight_vals],
+          num_samples=5,
+          sampled_projection=(tf.constant(w_t_val), tf.constant(b_val)))
+      # All steps share a single candidate sampler; fetch its samples in the
+      # same run to build the reference loss.
+      samplers = [op for op in tf.get_default_graph().get_operations()
+                  if op.type == "LogUniformCandidateSampler"]
+      self.assertEqual(1, len(samplers))
+      res, sampled, true_count, sampled_count = sess.run(
+          [loss_per_sequence] + list(samplers[0].outputs))
+
+      inputs = np.concatenate(output_vals)
+      labels = np.concatenate(target_vals)
+      true_logits = (np.sum(inputs * w_t_val[labels], 1) + b_val[labels] -
+                     np.log(true_count[:, 0]))
+      sampled_logits = (inputs.dot(w_t_val[sampled].T) + b_val[sampled] -
+                        np.log(sampled_count))
+      sampled_logits[labels[:, None] == sampled[None, :]] = -np.inf
+      all_logits = np.concatenate([true_logits[:, None], sampled_logits], 1)
+      crossent = np.log(np.sum(np.exp(all_logits), 1)) - true_logits
+      weights = np.stack(weight_vals)
+      self.assertAllClose(
+          np.sum(crossent.reshape([3, 2]) * weights, 0) / np.sum(weights, 0),
+          res)
+
+      with self.assertRaises(ValueError):
+        tf.nn.seq2seq.sequence_loss_by_example(
+            [tf.constant(o) for o in output_vals],
+            [tf.constant(t) for t in target_vals],
+            [tf.constant(w) for w in weight_vals],
+            num_samples=5)
+      with self.assertRaises(ValueError):
+        tf.nn.seq2seq.sequence_loss_by_example(
+            [tf.constant(o) for o in output_vals],
+            [tf.constant(t) for t in target_vals],
+            [tf.constant(w) for w in weight_vals],
+            sampled_projection=(tf.constant(w_t_val), tf.constant(b_val)))
+      with self.assertRaises(ValueError):
+        tf.nn.seq2seq.sequence_loss_by_example(
+            [tf.constant(o) for o in output_vals],
+            [tf.constant(t) for t in target_vals],
+            [tf.constant(w) for w in weight_vals],
+            num_samples=5,
+            sampled_projection=(
+                tf.placeholder(tf.float32, [None, output_size]),
+                tf.constant(b_val)))
+
   def testModelWithBucketsScopeAndLoss(self):
     """Test that variable scope reuse is not reset after model_with_buckets."""
     classes = 10
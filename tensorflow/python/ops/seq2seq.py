@@ -43,6 +43,7 @@ one of them, others should be easy to substitute.
 * Decoders (when you write your own encoder, you can use these to decode;
     e.g., if you want to write a model that generates captions for images).
   - rnn_decoder: The basic decoder based on a pure RNN.
+  - dynamic_rnn_decoder: As rnn_decoder, but runs the steps in a while_loop.
   - attention_decoder: A decoder that uses the attention mechanism.
 
 * Losses.
@@ -67,10 +68,12 @@ from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import control_flow_ops
 from tensorflow.python.ops import embedding_ops
+from tensorflow.python.ops import gen_math_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops import rnn
 from tensorflow.python.ops import rnn_cell
+from tensorflow.python.ops import tensor_array_ops
 from tensorflow.python.ops import variable_scope
 from tensorflow.python.util import nest
 
@@ -81,13 +84,60 @@ from tensorflow.models.rnn.translate.seq2seq.wrapper_cells import BOWCell
 
 from tensorflow.python.ops.math_ops import tanh
 
-from itertools import chain
 import tensorflow as tf
 
 import logging
 
+def _convert_output_projection(output_projection, num_symbols, dtype):
+  """Converts an output projection pair (W, B) to tensors and checks shapes.
+
+  Converting a Tensor is a no-op, so callers that build several decoders
+  (e.g. both branches of a feed_previous cond) should convert once up front
+  and pass the result down.
+
+  Raises:
+    ValueError: When output_projection has the wrong shape.
+  """
+  if output_projection is None:
+    return None
+  proj_weights = ops.convert_to_tensor(output_projection[0], dtype=dtype)
+  proj_weights.get_shape().assert_is_compatible_with([None, num_symbols])
+  proj_biases = ops.convert_to_tensor(output_projection[1], dtype=dtype)
+  proj_biases.get_shape().assert_is_compatible_with([num_symbols])
+  return proj_weights, proj_biases
+
+
+def _quantized_projection(output_projection):
+  """Returns a function computing prev * W + B with W quantized to 8 bits.
+
+  W is quantized once per session.run, not once per decoding step; each call
+  only quantizes its input and runs QuantizedMatMul. QuantizedMatMul has no
+  GPU kernel, so the quantized ops are pinned to /cpu:0. Only the argmax of
+  the result is used when decoding, so the rounding error is mostly harmless.
+  """
+  weights, biases = output_projection
+  with ops.device("/cpu:0"):
+    q_weights = array_ops.quantize_v2(
+        weights, math_ops.reduce_min(weights), math_ops.reduce_max(weights),
+        dtypes.quint8, mode="MIN_FIRST")
+
+  def project(prev):
+    with ops.device("/cpu:0"):
+      q_prev = array_ops.quantize_v2(
+          prev, math_ops.reduce_min(prev), math_ops.reduce_max(prev),
+          dtypes.quint8, mode="MIN_FIRST")
+      logits, logits_min, logits_max = gen_math_ops.quantized_mat_mul(
+          q_prev.output, q_weights.output, q_prev.output_min,
+          q_prev.output_max, q_weights.output_min, q_weights.output_max)
+      logits = array_ops.dequantize(logits, logits_min, logits_max,
+                                    mode="MIN_FIRST")
+    return nn_ops.bias_add(logits, biases)
+  return project
+
+
 def _extract_argmax_and_embed(embedding, output_projection=None,
-                              update_embedding=True):
+                              update_embedding=True,
+                              quantize_projection=False):
   """Get a loop_function that extracts the previous symbol and embeds it.
 
   Args:
@@ -96,18 +146,28 @@ def _extract_argmax_and_embed(embedding, output_projection=None,
       output will first be multiplied by W and added B.
     update_embedding: Boolean; if False, the gradients will not propagate
       through the embeddings.
+    quantize_projection: Boolean; if True, W is quantized to 8 bits and the
+      projection runs as a QuantizedMatMul (CPU only, no gradient). Meant for
+      inference-only greedy decoding.
 
   Returns:
     A loop function.
   """
+  if output_projection is not None and quantize_projection:
+    project = _quantized_projection(output_projection)
+  elif output_projection is not None:
+    project = lambda prev: nn_ops.xw_plus_b(
+        prev, output_projection[0], output_projection[1])
+
   def loop_function(prev, _):
     if output_projection is not None:
-      prev = nn_ops.xw_plus_b(
-          prev, output_projection[0], output_projection[1])
+      prev = project(prev)
     prev_symbol = math_ops.argmax(prev, 1)
     # Note that gradients will not propagate through the second parameter of
-    # embedding_lookup.
-    emb_prev = embedding_ops.embedding_lookup(embedding, prev_symbol)
+    # embedding_lookup. A partitioned embedding is gathered shard by shard on
+    # each shard's device; "div" matches how partitioners split its rows.
+    emb_prev = embedding_ops.embedding_lookup(embedding, prev_symbol,
+                                              partition_strategy="div")
     if not update_embedding:
       emb_prev = array_ops.stop_gradient(emb_prev)
     return emb_prev
@@ -186,6 +246,11 @@ def rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
         * i is an integer, the step number (when advanced control is needed),
         * next is a 2D Tensor of shape [batch_size x input_size].
     scope: VariableScope for the created subgraph; defaults to "rnn_decoder".
+    feed_prev_p: None or a float scalar; if set (and loop_function is given),
+      each step after the first feeds the previous output through
+      loop_function with probability feed_prev_p, and the given decoder input
+      otherwise. The decisions for all steps come from a single
+      random_uniform draw.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -207,27 +272,35 @@ def rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
       if bow_no_replace:
         logging.info('Sampling from bow mask without replacement')
 
-    for i, inp in enumerate(decoder_inputs):
-      reuse = (loop_function is not None and prev is not None) or (i > 0)
-      with variable_scope.variable_scope(scope or "rnn_decoder", reuse=reuse):
-
-        def inner_loop(prev, inp, i, feed_prev=False):
-          # mask input should be prev model output if feed_previous, otherwise true prev output
-          mask_inp = tf.no_op()
-          if feed_prev and (prev is not None):
-            inp = loop_function(prev, i)
-            if bow_no_replace:
-              mask_inp = tf.cast(tf.argmax(prev, 1), tf.int32)
-          elif bow_no_replace:
-            mask_inp = raw_inp[i]
-          return inp, mask_inp
-
-        if feed_prev_p is not None:
-          rv = tf.random_uniform([], minval=0, maxval=1, dtype=tf.float32)
-          feed_prev = (loop_function is not None) and tf.less(rv, feed_prev_p)
-          inp, mask_inp = control_flow_ops.cond(feed_prev,
-                                                lambda: inner_loop(prev, inp, i, feed_prev=False),
-                                                lambda: inner_loop(prev, inp, i, feed_prev=True))
+    decoder_inputs = list(decoder_inputs)
+    schedule = feed_prev_p is not None and loop_function is not None
+    if schedule:
+      # Draw the scheduled sampling decisions for all steps at once: step i
+      # feeds the previous output with probability feed_prev_p.
+      feed_prev_mask = tf.less(
+          tf.random_uniform([len(decoder_inputs)], minval=0, maxval=1,
+                            dtype=tf.float32), feed_prev_p)
+
+    def inner_loop(prev, inp, i, feed_prev=False):
+      # mask input should be prev model output if feed_previous, otherwise true prev output
+      mask_inp = tf.no_op()
+      if feed_prev and (prev is not None):
+        inp = loop_function(prev, i)
+        if bow_no_replace:
+          mask_inp = tf.cast(tf.argmax(prev, 1), tf.int32)
+      elif bow_no_replace:
+        mask_inp = raw_inp[i]
+      return inp, mask_inp
+
+    with variable_scope.variable_scope(scope or "rnn_decoder") as varscope:
+      for i, inp in enumerate(decoder_inputs):
+        if i > 0:
+          varscope.reuse_variables()
+
+        if schedule and prev is not None:
+          inp, mask_inp = control_flow_ops.cond(feed_prev_mask[i],
+                                                lambda: inner_loop(prev, inp, i, feed_prev=True),
+                                                lambda: inner_loop(prev, inp, i, feed_prev=False))
         else:
           feed_prev = (loop_function is not None)
           inp, mask_inp = inner_loop(prev, inp, i, feed_prev)
@@ -246,6 +319,84 @@ def rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
   return outputs, state
 
 
+def dynamic_rnn_decoder(decoder_inputs, initial_state, cell,
+                        loop_function=None, scope=None, feed_prev_p=None,
+                        parallel_iterations=32, swap_memory=False):
+  """RNN decoder that runs its steps in a single tf.while_loop.
+
+  Unlike rnn_decoder, the size of the graph does not grow with the number of
+  decoder steps: the cell is built once for the first step, which creates its
+  variables, and once for the body of the loop over the remaining steps.
+  Outputs are collected in a TensorArray.
+
+  Args:
+    decoder_inputs: A 3D Tensor [time x batch_size x input_size], or a list of
+      2D Tensors [batch_size x input_size] that is packed into one.
+    initial_state: 2D Tensor with shape [batch_size x cell.state_size].
+    cell: rnn_cell.RNNCell defining the cell function and size.
+    loop_function: As in rnn_decoder, except that the step number i passed to
+      it is an int32 scalar Tensor.
+    scope: VariableScope for the created subgraph; defaults to
+      "dynamic_rnn_decoder".
+    feed_prev_p: None or a float scalar; if set (and loop_function is given),
+      each step after the first feeds the previous output through
+      loop_function with probability feed_prev_p, and the given decoder
+      input otherwise.
+    parallel_iterations: Positive Python int, passed to tf.while_loop.
+    swap_memory: Python boolean, passed to tf.while_loop.
+
+  Returns:
+    A tuple of the form (outputs, state), where:
+      outputs: A 3D Tensor [time x batch_size x output_size] containing the
+        generated outputs.
+      state: The state of each cell at the final time-step.
+        It is a 2D Tensor of shape [batch_size x cell.state_size].
+  """
+  with variable_scope.variable_scope(
+      scope or "dynamic_rnn_decoder") as varscope:
+    if isinstance(decoder_inputs, (list, tuple)):
+      decoder_inputs = array_ops.pack(decoder_inputs)
+    input_shape = decoder_inputs.get_shape().with_rank(3)
+    time_steps = array_ops.shape(decoder_inputs)[0]
+
+    output, state = cell(decoder_inputs[0], initial_state)
+    varscope.reuse_variables()
+
+    input_ta = tensor_array_ops.TensorArray(
+        dtype=decoder_inputs.dtype, size=time_steps).unpack(decoder_inputs)
+    output_ta = tensor_array_ops.TensorArray(
+        dtype=output.dtype, size=time_steps).write(0, output)
+    if feed_prev_p is not None and loop_function is not None:
+      feed_prev_mask = tf.less(
+          tf.random_uniform([time_steps], minval=0, maxval=1,
+                            dtype=tf.float32), feed_prev_p)
+
+    def _time_step(time, prev, output_ta_t, state):
+      if loop_function is None:
+        inp = input_ta.read(time)
+      elif feed_prev_p is None:
+        inp = loop_function(prev, time)
+      else:
+        inp = control_flow_ops.cond(feed_prev_mask[time],
+                                    lambda: loop_function(prev, time),
+                                    lambda: input_ta.read(time))
+      inp.set_shape(input_shape[1:])
+      output, new_state = cell(inp, state)
+      return (time + 1, output, output_ta_t.write(time, output), new_state)
+
+    _, _, output_final_ta, state = control_flow_ops.while_loop(
+        cond=lambda time, *_: time < time_steps,
+        body=_time_step,
+        loop_vars=(array_ops.constant(1, dtype=dtypes.int32), output,
+                   output_ta, state),
+        parallel_iterations=parallel_iterations,
+        swap_memory=swap_memory)
+
+    outputs = output_final_ta.pack()
+    outputs.set_shape(input_shape[:2].concatenate(output.get_shape()[1:]))
+  return outputs, state
+
+
 def _mask_output(output, bow_mask, num_symbols, mask_inp):
   # normalize output over BoW by setting logits outside bag to zero
   if mask_inp is not None:
@@ -255,8 +406,106 @@ def _mask_output(output, bow_mask, num_symbols, mask_inp):
   output = output * norm_mask
   return output, bow_mask
 
+def _cudnn_encoder(cell, encoder_inputs, rnn_mode, dtype):
+  """Runs encoder_inputs through a fused cuDNN RNN shaped like cell.
+
+  The cuDNN kernel processes all time-steps and layers in a single call, but
+  keeps its weights in one opaque buffer ("cudnn_params"), so checkpoints are
+  not interchangeable with the rnn.rnn encoder.
+
+  Args:
+    cell: rnn_cell.RNNCell, or MultiRNNCell of cells with equal output_size,
+      whose state the returned encoder state is laid out for.
+    encoder_inputs: A list of 2D Tensors [batch_size x input_size].
+    rnn_mode: "lstm" or "gru".
+    dtype: The dtype of the encoder; cuDNN only supports tf.float32.
+
+  Returns:
+    The final encoder state, structured like cell.state_size.
+
+  Raises:
+    ValueError: If rnn_mode or dtype is not supported.
+  """
+  # Imported here since contrib depends on this module being importable.
+  from tensorflow.contrib.cudnn_rnn.python.ops import cudnn_rnn_ops
+  if rnn_mode not in ("lstm", "gru"):
+    raise ValueError("Unsupported cuDNN rnn_mode: %s" % rnn_mode)
+  if dtype != dtypes.float32:
+    raise ValueError("cuDNN encoder only supports float32, got %s" % dtype)
+  # pylint: disable=protected-access
+  if isinstance(cell, rnn_cell.OutputProjectionWrapper):
+    cell = cell._cell
+  if isinstance(cell, rnn_cell.MultiRNNCell):
+    cells = cell._cells
+  else:
+    cells = [cell]
+  # pylint: enable=protected-access
+  num_units = cells[0].state_size
+  if nest.is_sequence(num_units):
+    num_units = num_units[1]
+  elif rnn_mode == "lstm":
+    num_units //= 2
+
+  inputs = array_ops.pack(encoder_inputs)
+  input_size = inputs.get_shape().with_rank(3)[2].value
+  if rnn_mode == "lstm":
+    model = cudnn_rnn_ops.CudnnLSTM(len(cells), num_units, input_size)
+  else:
+    model = cudnn_rnn_ops.CudnnGRU(len(cells), num_units, input_size)
+  params = variable_scope.get_variable(
+      "cudnn_params",
+      initializer=tf.random_uniform([model.params_size()], -0.1, 0.1),
+      validate_shape=False)
+  zero_state = array_ops.zeros(
+      array_ops.pack([len(cells), array_ops.shape(inputs)[1], num_units]),
+      dtype=dtype)
+  if rnn_mode == "lstm":
+    _, output_h, output_c = model(inputs, zero_state, zero_state, params)
+  else:
+    _, output_h = model(inputs, zero_state, params)
+    output_c = output_h
+
+  states = []
+  for layer, h, c in zip(cells, array_ops.unpack(output_h, num=len(cells)),
+                         array_ops.unpack(output_c, num=len(cells))):
+    h.set_shape([None, num_units])
+    c.set_shape([None, num_units])
+    if rnn_mode == "gru":
+      states.append(h)
+    elif nest.is_sequence(layer.state_size):
+      states.append(rnn_cell.LSTMStateTuple(c, h))
+    else:
+      states.append(array_ops.concat(1, [c, h]))
+  if len(cells) == 1:
+    return states[0]
+  if nest.is_sequence(cell.state_size):
+    return tuple(states)
+  return array_ops.concat(1, states)
+
+
+def _rnn_encoder(cell, encoder_inputs, dtype, use_dynamic_rnn, scope=None):
+  """Runs cell over the list encoder_inputs and returns the final state.
+
+  With use_dynamic_rnn the inputs are packed into one time-major tensor and
+  run through rnn.dynamic_rnn, which builds a single while_loop instead of
+  one copy of the cell per step. Both paths create the same variables, so
+  checkpoints can be shared between them.
+  """
+  if not use_dynamic_rnn:
+    _, state = rnn.rnn(cell, encoder_inputs, dtype=dtype, scope=scope)
+    return state
+  inputs = array_ops.pack(encoder_inputs)
+  if inputs.get_shape().ndims == 2:
+    # Symbol ids for an EmbeddingWrapper, which flattens them again.
+    inputs = array_ops.expand_dims(inputs, 2)
+  _, state = rnn.dynamic_rnn(cell, inputs, dtype=dtype, time_major=True,
+                             scope=scope)
+  return state
+
+
 def basic_rnn_seq2seq(
-    encoder_inputs, decoder_inputs, cell, dtype=dtypes.float32, scope=None):
+    encoder_inputs, decoder_inputs, cell, dtype=dtypes.float32, scope=None,
+    encoder_impl=None, use_dynamic_rnn=False):
   """Basic RNN sequence-to-sequence model.
 
   This model first runs an RNN to encode encoder_inputs into a state vector,
@@ -269,6 +518,12 @@ def basic_rnn_seq2seq(
     cell: rnn_cell.RNNCell defining the cell function and size.
     dtype: The dtype of the initial state of the RNN cell (default: tf.float32).
     scope: VariableScope for the created subgraph; default: "basic_rnn_seq2seq".
+    encoder_impl: None to run the encoder with rnn.rnn, or "lstm" / "gru" to
+      run it as one fused cuDNN kernel (GPU only); cell must then be a
+      matching LSTM or GRU cell, or a MultiRNNCell of them.
+    use_dynamic_rnn: Boolean; if True, the encoder runs as one
+      rnn.dynamic_rnn while_loop over the packed encoder_inputs instead of
+      being unrolled with rnn.rnn. Variables are the same either way.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -278,12 +533,17 @@ def basic_rnn_seq2seq(
         It is a 2D Tensor of shape [batch_size x cell.state_size].
   """
   with variable_scope.variable_scope(scope or "basic_rnn_seq2seq"):
-    _, enc_state = rnn.rnn(cell, encoder_inputs, dtype=dtype)
+    if encoder_impl is not None:
+      with variable_scope.variable_scope("RNN"):
+        enc_state = _cudnn_encoder(cell, encoder_inputs, encoder_impl, dtype)
+    else:
+      enc_state = _rnn_encoder(cell, encoder_inputs, dtype, use_dynamic_rnn)
     return rnn_decoder(decoder_inputs, enc_state, cell)
 
 
 def tied_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
-                     loop_function=None, dtype=dtypes.float32, scope=None):
+                     loop_function=None, dtype=dtypes.float32, scope=None,
+                     use_dynamic_rnn=False, feed_prev_p=None):
   """RNN sequence-to-sequence model with tied encoder and decoder parameters.
 
   This model first runs an RNN to encode encoder_inputs into a state vector, and
@@ -299,6 +559,11 @@ def tied_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
       except for the first element ("GO" symbol), see rnn_decoder for details.
     dtype: The dtype of the initial state of the rnn cell (default: tf.float32).
     scope: VariableScope for the created subgraph; default: "tied_rnn_seq2seq".
+    use_dynamic_rnn: Boolean; if True, the encoder runs as one
+      rnn.dynamic_rnn while_loop over the packed encoder_inputs instead of
+      being unrolled with rnn.rnn. Variables are the same either way.
+    feed_prev_p: None or a scalar float Tensor; passed to rnn_decoder as the
+      probability of applying loop_function at each step.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -310,11 +575,12 @@ def tied_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
   """
   with variable_scope.variable_scope("combined_tied_rnn_seq2seq"):
     scope = scope or "tied_rnn_seq2seq"
-    _, enc_state = rnn.rnn(
-        cell, encoder_inputs, dtype=dtype, scope=scope)
+    enc_state = _rnn_encoder(cell, encoder_inputs, dtype, use_dynamic_rnn,
+                             scope=scope)
     variable_scope.get_variable_scope().reuse_variables()
     return rnn_decoder(decoder_inputs, enc_state, cell,
-                       loop_function=loop_function, scope=scope)
+                       loop_function=loop_function, scope=scope,
+                       feed_prev_p=feed_prev_p)
 
 def embedding_rnn_decoder(decoder_inputs,
                           initial_state,
@@ -328,11 +594,15 @@ def embedding_rnn_decoder(decoder_inputs,
                           bow_mask=None,
                           bow_no_replace=False,
                           feed_prev_p=None,
-                          grammar=None):
+                          grammar=None,
+                          quantize_projection=False,
+                          embedding_partitioner=None):
   """RNN decoder with embedding and a pure-decoding option.
 
   Args:
-    decoder_inputs: A list of 1D batch-sized int32 Tensors (decoder inputs).
+    decoder_inputs: A list of 1D batch-sized int32 Tensors (decoder inputs),
+      or a single 2D int32 Tensor [time x batch_size] with a static time
+      dimension.
     initial_state: 2D Tensor [batch_size x cell.state_size].
     cell: rnn_cell.RNNCell defining the cell function.
     num_symbols: Integer, how many symbols come into the embedding.
@@ -354,6 +624,15 @@ def embedding_rnn_decoder(decoder_inputs,
       no effect if feed_previous=False.
     scope: VariableScope for the created subgraph; defaults to
       "embedding_rnn_decoder".
+    quantize_projection: Boolean; if True and feed_previous=True, the fed
+      previous outputs are projected with an 8-bit quantized copy of W
+      (CPU only, no gradient); use it for inference-only decoding.
+    embedding_partitioner: Optional partitioner for the embedding variable,
+      e.g. tf.fixed_size_partitioner(num_shards), to shard a large vocabulary
+      across parameter devices; lookups use the "div" partition strategy.
+      Without a partitioner the embedding is created on /cpu:0, whatever the
+      enclosing device scope; with one, the caller's device scope or device
+      function places the shards.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -371,24 +650,34 @@ def embedding_rnn_decoder(decoder_inputs,
   """
   schedule = True if feed_prev_p is not None else False
   with variable_scope.variable_scope(scope or "embedding_rnn_decoder") as scope:
-    if output_projection is not None:
-      dtype = scope.dtype
-      proj_weights = ops.convert_to_tensor(output_projection[0], dtype=dtype)
-      proj_weights.get_shape().assert_is_compatible_with([None, num_symbols])
-      proj_biases = ops.convert_to_tensor(output_projection[1], dtype=dtype)
-      proj_biases.get_shape().assert_is_compatible_with([num_symbols])
-
-    embedding = variable_scope.get_variable("embedding",
-                                            [num_symbols, embedding_size])
+    output_projection = _convert_output_projection(
+        output_projection, num_symbols, scope.dtype)
+
+    if embedding_partitioner is None:
+      # Keep the table in host memory, as EmbeddingWrapper does; only the
+      # gathered rows are copied to the device.
+      with ops.device("/cpu:0"):
+        embedding = variable_scope.get_variable("embedding",
+                                                [num_symbols, embedding_size])
+    else:
+      embedding = variable_scope.get_variable("embedding",
+                                              [num_symbols, embedding_size],
+                                              partitioner=embedding_partitioner)
     if (feed_previous or schedule):
       loop_function = _extract_argmax_and_embed(
         embedding, output_projection,
-        update_embedding_for_previous)
+        update_embedding_for_previous, quantize_projection)
     else:
       loop_function = None
-    emb_inp = (
-        embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs)
-  
+    # One gather for all steps instead of one per decoder input.
+    if isinstance(decoder_inputs, (list, tuple)):
+      decoder_ids = array_ops.pack(decoder_inputs)
+    else:
+      decoder_ids = ops.convert_to_tensor(decoder_inputs)
+    # embedding_lookup runs each gather next to its table or shard.
+    emb_inp = array_ops.unpack(embedding_ops.embedding_lookup(
+        embedding, decoder_ids, partition_strategy="div"))
+
     if grammar is not None:
       return rnn_grammar_decoder(emb_inp, initial_state, 
                                    cell, grammar=grammar, 
@@ -412,7 +701,9 @@ def embedding_rnn_seq2seq(encoder_inputs,
                           output_projection=None,
                           feed_previous=False,
                           dtype=None,
-                          scope=None):
+                          scope=None,
+                          encoder_impl=None,
+                          use_dynamic_rnn=False):
   """Embedding RNN sequence-to-sequence model.
 
   This model first embeds encoder_inputs by a newly created embedding (of shape
@@ -432,7 +723,11 @@ def embedding_rnn_seq2seq(encoder_inputs,
     output_projection: None or a pair (W, B) of output projection weights and
       biases; W has shape [output_size x num_decoder_symbols] and B has
       shape [num_decoder_symbols]; if provided and feed_previous=True, each
-      fed previous output will first be multiplied by W and added B.
+      fed previous output will first be multiplied by W and added B. The
+      decoder outputs are then left unprojected ([batch_size x output_size]),
+      which avoids a [batch_size x num_decoder_symbols] tensor per step when
+      training with a loss that takes W and B itself, such as
+      sampled_softmax_loss.
     feed_previous: Boolean or scalar Boolean Tensor; if True, only the first
       of decoder_inputs will be used (the "GO" symbol), and all other decoder
       inputs will be taken from previous outputs (as in embedding_rnn_decoder).
@@ -441,6 +736,12 @@ def embedding_rnn_seq2seq(encoder_inputs,
       rnn cells (default: tf.float32).
     scope: VariableScope for the created subgraph; defaults to
       "embedding_rnn_seq2seq"
+    encoder_impl: None to run the encoder with rnn.rnn, or "lstm" / "gru" to
+      run it as one fused cuDNN kernel (GPU only); cell must then be a
+      matching LSTM or GRU cell, or a MultiRNNCell of them.
+    use_dynamic_rnn: Boolean; if True, the encoder runs as one
+      rnn.dynamic_rnn while_loop over the packed encoder_inputs instead of
+      being unrolled with rnn.rnn. Variables are the same either way.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -460,14 +761,27 @@ def embedding_rnn_seq2seq(encoder_inputs,
       dtype = scope.dtype
 
     # Encoder.
-    encoder_cell = rnn_cell.EmbeddingWrapper(
-        cell, embedding_classes=num_encoder_symbols,
-        embedding_size=embedding_size)
-    _, encoder_state = rnn.rnn(encoder_cell, encoder_inputs, dtype=dtype)
+    if encoder_impl is not None:
+      with variable_scope.variable_scope("RNN"):
+        with variable_scope.variable_scope("EmbeddingWrapper"), \
+            ops.device("/cpu:0"):
+          embedding = variable_scope.get_variable(
+              "embedding", [num_encoder_symbols, embedding_size])
+          encoder_emb = array_ops.unpack(embedding_ops.embedding_lookup(
+              embedding, array_ops.pack(encoder_inputs)))
+        encoder_state = _cudnn_encoder(cell, encoder_emb, encoder_impl, dtype)
+    else:
+      encoder_cell = rnn_cell.EmbeddingWrapper(
+          cell, embedding_classes=num_encoder_symbols,
+          embedding_size=embedding_size)
+      encoder_state = _rnn_encoder(encoder_cell, encoder_inputs, dtype,
+                                   use_dynamic_rnn)
 
     # Decoder.
     if output_projection is None:
       cell = rnn_cell.OutputProjectionWrapper(cell, num_decoder_symbols)
+    output_projection = _convert_output_projection(
+        output_projection, num_decoder_symbols, dtype)
 
     if isinstance(feed_previous, bool):
       return embedding_rnn_decoder(
@@ -479,31 +793,18 @@ def embedding_rnn_seq2seq(encoder_inputs,
           output_projection=output_projection,
           feed_previous=feed_previous)
 
-    # If feed_previous is a Tensor, we construct 2 graphs and use cond.
-    def decoder(feed_previous_bool):
-      reuse = None if feed_previous_bool else True
-      with variable_scope.variable_scope(
-          variable_scope.get_variable_scope(), reuse=reuse) as scope:
-        outputs, state = embedding_rnn_decoder(
-            decoder_inputs, encoder_state, cell, num_decoder_symbols,
-            embedding_size, output_projection=output_projection,
-            feed_previous=feed_previous_bool,
-            update_embedding_for_previous=False)
-        state_list = [state]
-        if nest.is_sequence(state):
-          state_list = nest.flatten(state)
-        return outputs + state_list
-
-    outputs_and_state = control_flow_ops.cond(feed_previous,
-                                              lambda: decoder(True),
-                                              lambda: decoder(False))
-    outputs_len = len(decoder_inputs)  # Outputs length same as decoder inputs.
-    state_list = outputs_and_state[outputs_len:]
-    state = state_list[0]
-    if nest.is_sequence(encoder_state):
-      state = nest.pack_sequence_as(structure=encoder_state,
-                                    flat_sequence=state_list)
-    return outputs_and_state[:outputs_len], state
+    # If feed_previous is a Tensor, build a single decoder whose steps feed
+    # the previous output with probability 1 or 0, rather than two decoders
+    # joined by a cond.
+    return embedding_rnn_decoder(
+        decoder_inputs,
+        encoder_state,
+        cell,
+        num_decoder_symbols,
+        embedding_size,
+        output_projection=output_projection,
+        update_embedding_for_previous=False,
+        feed_prev_p=math_ops.cast(feed_previous, dtypes.float32))
 
 
 def embedding_rnn_autoencoder_seq2seq(encoder_inputs, decoder_inputs, cell,
@@ -515,7 +816,7 @@ def embedding_rnn_autoencoder_seq2seq(encoder_inputs, decoder_inputs, cell,
                                initializer=None, legacy=False, 
                                feed_prev_p=None, bow_mask=None,
                               bow_no_replace=False,
-                              grammar=None):
+                              grammar=None, embedding_partitioner=None):
   with variable_scope.variable_scope(
       scope or "embedding_rnn_seq2seq", dtype=dtype) as scope:
     dtype = scope.dtype
@@ -559,6 +860,8 @@ def embedding_rnn_autoencoder_seq2seq(encoder_inputs, decoder_inputs, cell,
     # Decoder.
     if output_projection is None:
       cell = rnn_cell.OutputProjectionWrapper(cell, num_symbols)
+    output_projection = _convert_output_projection(
+        output_projection, num_symbols, dtype)
 
     if isinstance(feed_previous, bool):
       if hidden_state is not None:
@@ -568,7 +871,7 @@ def embedding_rnn_autoencoder_seq2seq(encoder_inputs, decoder_inputs, cell,
         embedding_size, output_projection=output_projection,
         feed_previous=feed_previous, feed_prev_p=feed_prev_p,
         bow_mask=bow_mask, bow_no_replace=bow_no_replace,
-        grammar=grammar)
+        grammar=grammar, embedding_partitioner=embedding_partitioner)
       return outputs, initial_state
 
     # If feed_previous is a Tensor, we construct 2 graphs and use cond.
@@ -583,7 +886,7 @@ def embedding_rnn_autoencoder_seq2seq(encoder_inputs, decoder_inputs, cell,
           feed_previous=feed_previous_bool,
           update_embedding_for_previous=False, feed_prev_p=feed_prev_p,
           bow_mask=bow_mask, bow_no_replace=bow_no_replace,
-          grammar=grammar)
+          grammar=grammar, embedding_partitioner=embedding_partitioner)
         return outputs + [initial_state]
 
     outputs_and_state = control_flow_ops.cond(feed_previous,
@@ -604,7 +907,8 @@ def embedding_rnn_vae_seq2seq(encoder_inputs, decoder_inputs, cell,
                               anneal_scale=None, sample_mean=False,
                               dec_cell=None, concat_encoded=False,
                               bow_mask=None, bow_no_replace=False,
-                              mean_kl=False, grammar=None):
+                              mean_kl=False, grammar=None,
+                              embedding_partitioner=None):
   with variable_scope.variable_scope(
     scope or "embedding_rnn_seq2seq", dtype=dtype) as scope:
     dtype = scope.dtype
@@ -638,22 +942,38 @@ def embedding_rnn_vae_seq2seq(encoder_inputs, decoder_inputs, cell,
         reverse=True)    
     if output_projection is None:
       dec_cell = rnn_cell.OutputProjectionWrapper(dec_cell, num_symbols)
+    output_projection = _convert_output_projection(
+        output_projection, num_symbols, dtype)
     
     # Latent state
     if isinstance(encoder_out_state, tuple):
-      encoder_out_state = tf.concat(concat_dim=1, values=encoder_out_state)
+      enc_state_parts = tuple(encoder_out_state)
+    else:
+      enc_state_parts = (encoder_out_state,)
     enc_state_size = get_state_size(enc_cell)
     z_mean_w = tf.get_variable('z_mean_w', [enc_state_size, latent_size])
     z_mean_b = tf.get_variable('z_mean_b', [latent_size])
     z_logvar_w = tf.get_variable('z_logvar_w', [enc_state_size, latent_size])
     z_logvar_b = tf.get_variable('z_logvar_b', [latent_size])
 
-    z_mean = transfer_func(tf.add(tf.matmul(encoder_out_state, z_mean_w), z_mean_b))
-    z_log_var = transfer_func(tf.add(tf.matmul(encoder_out_state, z_logvar_w), z_logvar_b))
+    # One GEMM for both heads; the variables stay separate so existing
+    # checkpoints still load.
+    z_proj_w = tf.concat(1, [z_mean_w, z_logvar_w])
+    z_proj_b = tf.concat(0, [z_mean_b, z_logvar_b])
+    # A tuple state is multiplied part by part against the matching rows of
+    # the weights instead of being concatenated into one [batch, 2H] tensor.
+    z_proj = tf.add_n([
+        tf.matmul(part, part_w) for part, part_w in zip(
+            enc_state_parts, tf.split(0, len(enc_state_parts), z_proj_w))])
+    z_mean, z_log_var = tf.split(1, 2, transfer_func(
+        tf.nn.bias_add(z_proj, z_proj_b)))
     eps = tf.random_normal(tf.shape(z_log_var), 0, 1, dtype=tf.float32)
-    z = tf.add(z_mean, tf.mul(tf.sqrt(tf.exp(z_log_var)), eps))
+    # exp(0.5 * log_var) is the standard deviation; squaring it gives the
+    # variance for the KL term without a second exp.
+    z_std = tf.exp(0.5 * z_log_var)
+    z = tf.add(z_mean, tf.mul(z_std, eps))
 
-    kl_loss = -0.5 * (1.0 + z_log_var - tf.square(z_mean) - tf.exp(z_log_var))
+    kl_loss = -0.5 * (1.0 + z_log_var - tf.square(z_mean) - tf.square(z_std))
     kl_step_av = tf.reduce_mean(kl_loss, [0]) # average across batch
     kl_op = tf.reduce_mean if mean_kl else tf.reduce_sum
     if kl_min > 0.0:
@@ -675,9 +995,10 @@ def embedding_rnn_vae_seq2seq(encoder_inputs, decoder_inputs, cell,
       logging.info('Concatenating latent and hidden states')
       if isinstance(dec_cell.state_size, tuple):
         logging.info('Splitting fed hidden state before concatenation')
-        enc_state_tuple = tuple(tf.split(1, 2, encoder_out_state))
-        initial_state = (tf.concat(concat_dim=1, values=[state, z]) 
-                         for state in enc_state_tuple)
+        if len(enc_state_parts) == 1:
+          enc_state_parts = tuple(tf.split(1, 2, encoder_out_state))
+        initial_state = tuple(tf.concat(concat_dim=1, values=[state, z])
+                              for state in enc_state_parts)
       else:
         initial_state = tf.concat(concat_dim=1, values=[initial_state, z])
     else:
@@ -694,7 +1015,7 @@ def embedding_rnn_vae_seq2seq(encoder_inputs, decoder_inputs, cell,
         embedding_size, output_projection=output_projection,
         feed_previous=feed_previous, feed_prev_p=feed_prev_p,
         bow_mask=bow_mask, bow_no_replace=bow_no_replace,
-        grammar=grammar)
+        grammar=grammar, embedding_partitioner=embedding_partitioner)
       return outputs, z, kl_obj
 
     # If feed_previous is a Tensor, we construct 2 graphs and use cond.
@@ -708,7 +1029,7 @@ def embedding_rnn_vae_seq2seq(encoder_inputs, decoder_inputs, cell,
           feed_previous=feed_previous_bool,
           update_embedding_for_previous=False, feed_prev_p=feed_prev_p,
           bow_mask=bow_mask, bow_no_replace=bow_no_replace,
-          grammar=grammar)
+          grammar=grammar, embedding_partitioner=embedding_partitioner)
         return outputs + [z]
 
     outputs_and_state = control_flow_ops.cond(feed_previous,
@@ -744,6 +1065,7 @@ def embedding_tied_rnn_seq2seq(encoder_inputs,
     cell: rnn_cell.RNNCell defining the cell function and size.
     num_symbols: Integer; number of symbols for both encoder and decoder.
     embedding_size: Integer, the length of the embedding vector for each symbol.
+      The embedding is created on /cpu:0, whatever the enclosing device scope.
     num_decoder_symbols: Integer; number of output symbols for decoder. If
       provided, the decoder output is over symbols 0 to num_decoder_symbols - 1.
       Otherwise, decoder output is over symbols 0 to num_symbols - 1. Note that
@@ -777,19 +1099,20 @@ def embedding_tied_rnn_seq2seq(encoder_inputs,
       scope or "embedding_tied_rnn_seq2seq", dtype=dtype) as scope:
     dtype = scope.dtype
 
-    if output_projection is not None:
-      proj_weights = ops.convert_to_tensor(output_projection[0], dtype=dtype)
-      proj_weights.get_shape().assert_is_compatible_with([None, num_symbols])
-      proj_biases = ops.convert_to_tensor(output_projection[1], dtype=dtype)
-      proj_biases.get_shape().assert_is_compatible_with([num_symbols])
-
-    embedding = variable_scope.get_variable(
-        "embedding", [num_symbols, embedding_size], dtype=dtype)
-
-    emb_encoder_inputs = [embedding_ops.embedding_lookup(embedding, x)
-                          for x in encoder_inputs]
-    emb_decoder_inputs = [embedding_ops.embedding_lookup(embedding, x)
-                          for x in decoder_inputs]
+    output_projection = _convert_output_projection(
+        output_projection, num_symbols, dtype)
+
+    # Encoder and decoder share the table, so embed all their steps with a
+    # single gather and split the result afterwards. The table stays in host
+    # memory; only the gathered rows are copied to the device.
+    with ops.device("/cpu:0"):
+      embedding = variable_scope.get_variable(
+          "embedding", [num_symbols, embedding_size], dtype=dtype)
+      emb_inputs = array_ops.unpack(embedding_ops.embedding_lookup(
+          embedding,
+          array_ops.pack(list(encoder_inputs) + list(decoder_inputs))))
+    emb_encoder_inputs = emb_inputs[:len(encoder_inputs)]
+    emb_decoder_inputs = emb_inputs[len(encoder_inputs):]
 
     output_symbols = num_symbols
     if num_decoder_symbols is not None:
@@ -803,39 +1126,15 @@ def embedding_tied_rnn_seq2seq(encoder_inputs,
       return tied_rnn_seq2seq(emb_encoder_inputs, emb_decoder_inputs, cell,
                               loop_function=loop_function, dtype=dtype)
 
-    # If feed_previous is a Tensor, we construct 2 graphs and use cond.
-    def decoder(feed_previous_bool):
-      loop_function = _extract_argmax_and_embed(
-        embedding, output_projection, False) if feed_previous_bool else None
-      reuse = None if feed_previous_bool else True
-      with variable_scope.variable_scope(variable_scope.get_variable_scope(),
-                                         reuse=reuse):
-        outputs, state = tied_rnn_seq2seq(
-            emb_encoder_inputs, emb_decoder_inputs, cell,
-            loop_function=loop_function, dtype=dtype)
-        state_list = [state]
-        if nest.is_sequence(state):
-          state_list = nest.flatten(state)
-        return outputs + state_list
-
-    outputs_and_state = control_flow_ops.cond(feed_previous,
-                                              lambda: decoder(True),
-                                              lambda: decoder(False))
-    outputs_len = len(decoder_inputs)  # Outputs length same as decoder inputs.
-    state_list = outputs_and_state[outputs_len:]
-    state = state_list[0]
-    # Calculate zero-state to know its structure.
-    static_batch_size = encoder_inputs[0].get_shape()[0]
-    for inp in encoder_inputs[1:]:
-      static_batch_size.merge_with(inp.get_shape()[0])
-    batch_size = static_batch_size.value
-    if batch_size is None:
-      batch_size = array_ops.shape(encoder_inputs[0])[0]
-    zero_state = cell.zero_state(batch_size, dtype)
-    if nest.is_sequence(zero_state):
-      state = nest.pack_sequence_as(structure=zero_state,
-                                    flat_sequence=state_list)
-    return outputs_and_state[:outputs_len], state
+    # If feed_previous is a Tensor, build a single decoder whose steps feed
+    # the previous output with probability 1 or 0, rather than two decoders
+    # joined by a cond.
+    loop_function = _extract_argmax_and_embed(
+        embedding, output_projection, False)
+    return tied_rnn_seq2seq(emb_encoder_inputs, emb_decoder_inputs, cell,
+                            loop_function=loop_function, dtype=dtype,
+                            feed_prev_p=math_ops.cast(feed_previous,
+                                                      dtypes.float32))
 
 def attention_decoder(decoder_inputs,
                       initial_state,
@@ -853,7 +1152,11 @@ def attention_decoder(decoder_inputs,
                       encoder="reverse",
                       init_const=False,
                       bow_mask=None,
-                      grammar=None):
+                      grammar=None,
+                      use_while_loop=False,
+                      swap_memory=False,
+                      attention_type="additive",
+                      feed_previous_cond=None):
   """RNN decoder with attention for the sequence-to-sequence model.
 
   In this context "attention" means that, during decoding, the RNN can look up
@@ -884,6 +1187,19 @@ def attention_decoder(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    use_while_loop: If True, only the first step is built directly; the other
+      steps run as the body of a single tf.while_loop, so the graph does not
+      grow with len(decoder_inputs). loop_function then receives the step
+      number as an int32 scalar Tensor. Not supported together with grammar.
+    swap_memory: Passed to tf.while_loop when use_while_loop is True.
+    attention_type: "additive" (default) scores positions with
+      v^T * tanh(W1 * h_t + W2 * query); "dot" uses the scaled dot product
+      (W1 * h_t) . (W2 * query) / sqrt(attn_size), which needs no tanh over
+      [batch_size x attn_length x attn_size] per step and no AttnV variables.
+    feed_previous_cond: None or a scalar boolean Tensor; if given, the
+      loop_function output is used as the next input only when it is True,
+      and decoder_inputs are used otherwise. This switches between training
+      and greedy decoding with a single decoder graph.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -903,13 +1219,18 @@ def attention_decoder(decoder_inputs,
 
   Raises:
     ValueError: when num_heads is not positive, there are no inputs, shapes
-      of attention_states are not set, or input size cannot be inferred
-      from the input.
+      of attention_states are not set, input size cannot be inferred
+      from the input, or use_while_loop is combined with grammar.
   """
   if not decoder_inputs:
     raise ValueError("Must provide at least 1 input to attention decoder.")
   if num_heads < 1:
     raise ValueError("With less than 1 heads, use a non-attention decoder.")
+  if attention_type not in ("additive", "dot"):
+    raise ValueError("Unknown attention_type: %s" % attention_type)
+  if use_while_loop and grammar is not None:
+    raise ValueError("The grammar stack needs the unrolled decoder; "
+                     "use_while_loop must be False.")
   if attention_states.get_shape()[2].value is None:
     raise ValueError("Shape[2] of attention_states must be known: %s"
                      % attention_states.get_shape())
@@ -927,18 +1248,35 @@ def attention_decoder(decoder_inputs,
     attn_size = attention_states.get_shape()[2].value
     logging.info("Attn_length=%d attn_size=%d" % (attn_length, attn_size))
 
-    # To calculate W1 * h_t we use a 1-by-1 convolution, need to reshape before.
-    hidden = array_ops.reshape(
-        attention_states, [-1, attn_length, 1, attn_size])
+    # W1 * h_t for all heads as one matmul over the flattened states. The
+    # weights keep their [1, 1, attn_size, attention_vec_size] 1x1-conv shape
+    # so existing checkpoints still load.
     hidden_features = []
     v = []
     attention_vec_size = attn_size  # Size of query vectors for attention.
+    ks = []
     for a in xrange(num_heads):
       k = variable_scope.get_variable("AttnW_%d" % a,
                                       [1, 1, attn_size, attention_vec_size])
-      hidden_features.append(nn_ops.conv2d(hidden, k, [1, 1, 1, 1], "SAME"))
-      v.append(
-          variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size]))
+      ks.append(array_ops.reshape(k, [attn_size, attention_vec_size]))
+      if attention_type == "additive":
+        v.append(
+            variable_scope.get_variable("AttnV_%d" % a, [attention_vec_size]))
+    features = math_ops.matmul(
+        array_ops.reshape(attention_states, [-1, attn_size]),
+        array_ops.concat(1, ks) if num_heads > 1 else ks[0])
+    for head_features in array_ops.split(1, num_heads, features):
+      hidden_features.append(array_ops.reshape(
+          head_features, [-1, attn_length, attention_vec_size]))
+
+    # Padded source positions get a large negative score so they receive no
+    # attention after the softmax; computed once for all heads and steps.
+    # The score must stay finite in dtype: an all-padding row of -inf scores
+    # would make the softmax nan, and -1e9 overflows float16.
+    mask_bias = None
+    if src_mask is not None:
+      mask_score = -1e4 if dtype == dtypes.float16 else -1e9
+      mask_bias = (1.0 - math_ops.cast(src_mask, dtype)) * mask_score
 
     def is_LSTM_cell(cell):
       if isinstance(cell, rnn_cell.LSTMCell) or \
@@ -955,14 +1293,14 @@ def attention_decoder(decoder_inputs,
     def init_state():
       logging.info("Init decoder state for bow")
       for head in xrange(num_heads):
-        # matrix of ones
-        s = array_ops.ones(array_ops.pack([batch_size, attn_length]), dtype=dtype)
-        s.set_shape([None, attn_length])
-
-        # multiply with source mask, then do softmax: a_i = 1/src_length
+        # uniform weights over the source: a_i = 1/src_length
         if src_mask is not None:
-          s = s * src_mask
-        a = nn_ops.softmax(s)
+          a = src_mask / (math_ops.reduce_sum(src_mask, 1, keep_dims=True)
+                          + 1e-9)
+        else:
+          a = array_ops.ones(array_ops.pack([batch_size, attn_length]),
+                             dtype=dtype) / math_ops.cast(attn_length, dtype)
+          a.set_shape([None, attn_length])
 
         from tensorflow.models.rnn.translate.seq2seq.wrapper_cells import BOWCell
         if isinstance(cell, BOWCell) and \
@@ -972,8 +1310,8 @@ def attention_decoder(decoder_inputs,
             (is_LSTM_cell(cell.get_cell()._cells[0]) or \
              is_LSTM_cell_with_dropout(cell.get_cell()._cells[0])))):
             # C = SUM_t a_t * C~_t or C = SUM_t a_t * i_t * C~_t (hidden is either C~_t or i_t * C~_t, see BOWCell.embed)
-            C = math_ops.reduce_sum(
-                array_ops.reshape(a, [-1, attn_length, 1, 1]) * hidden, [1, 2])
+            C = array_ops.reshape(math_ops.batch_matmul(
+                array_ops.expand_dims(a, 1), attention_states), [-1, attn_size])
             h = tanh(C)
             if is_LSTM_cell(cell.get_cell()) or \
               is_LSTM_cell_with_dropout(cell.get_cell()):
@@ -981,13 +1319,8 @@ def attention_decoder(decoder_inputs,
               return array_ops.concat(1, [C, h])
             else:
               # MultiRNNCell (multi LSTM cell)
-              unit = array_ops.concat(1, [C, h])
-              state = unit
-              count = 1
-              while (count < cell.get_cell().num_layers):
-                state = array_ops.concat(1, [state, unit])
-                count += 1
-              return state
+              return array_ops.tile(array_ops.concat(1, [C, h]),
+                                    [1, cell.get_cell().num_layers])
         else:
           raise NotImplementedError("Need to implement decoder state initialization for non-LSTM cells")
 
@@ -1013,35 +1346,110 @@ def attention_decoder(decoder_inputs,
         query = array_ops.concat(1, query_list)
       for head in xrange(num_heads):
         with variable_scope.variable_scope("Attention_%d" % head):
-          y = linear(query, attention_vec_size, True)
-          y = array_ops.reshape(y, [-1, 1, 1, attention_vec_size])
-          # Attention mask is a softmax of v^T * tanh(...).
-          s = math_ops.reduce_sum(
-              v[head] * math_ops.tanh(hidden_features[head] + y), [2, 3])
-          # multiply with source mask, then do softmax
-          if src_mask is not None:
-            s = s * src_mask
+          if attention_type == "dot":
+            # Scaled dot product of the precomputed keys with the query.
+            y = linear(query, attention_vec_size, False)
+            s = array_ops.squeeze(math_ops.batch_matmul(
+                hidden_features[head], array_ops.expand_dims(y, 2)), [2])
+            s *= attention_vec_size ** -0.5
+          else:
+            y = linear(query, attention_vec_size, True)
+            y = array_ops.expand_dims(y, 1)
+            # Attention mask is a softmax of v^T * tanh(...).
+            s = math_ops.reduce_sum(
+                v[head] * math_ops.tanh(hidden_features[head] + y), [2])
+          # add the source mask bias, then do softmax
+          if mask_bias is not None:
+            s += mask_bias
           a = nn_ops.softmax(s)
-          # Now calculate the attention-weighted vector d.
-          d = math_ops.reduce_sum(
-              array_ops.reshape(a, [-1, attn_length, 1, 1]) * hidden, [1, 2])
+          # Now calculate the attention-weighted vector d as a batched
+          # [1 x attn_length] * [attn_length x attn_size] product.
+          d = math_ops.batch_matmul(array_ops.expand_dims(a, 1),
+                                    attention_states)
           ds.append(array_ops.reshape(d, [-1, attn_size]))
       return ds
 
-    outputs = []
-    prev = None
-    batch_attn_size = array_ops.pack([batch_size, attn_size])
-    attns = [array_ops.zeros(batch_attn_size, dtype=dtype)
-             for _ in xrange(num_heads)]
-    for a in attns:  # Ensure the second shape of attention vectors is set.
-      a.set_shape([None, attn_size])
     if initial_state_attention:
       attns = attention(initial_state)
+    else:
+      # One zero attention read, shared by all heads and only built if used.
+      # A static batch size gives a constant; otherwise zeros packs the
+      # run-time batch size with the static attn_size, which stays known.
+      attn_batch_size = attention_states.get_shape()[0].value
+      if attn_batch_size is None:
+        attn_batch_size = array_ops.shape(attention_states)[0]
+      zero_attn = array_ops.zeros([attn_batch_size, attn_size], dtype=dtype)
+      attns = [zero_attn] * num_heads
 
     if maxout_layer:
       logging.info("Output layer consists of: Merge, Bias, Maxout, Linear, Linear")
     if bow_mask is not None:
       logging.info("Use bow mask to locally normalize output layer wrt bow vocabulary")
+      # Vocabulary ids in the bag of any sentence in the batch.
+      bow_ids = math_ops.to_int32(array_ops.reshape(
+          array_ops.where(math_ops.reduce_max(bow_mask, [0]) > 0), [-1]))
+    bow_projection = {}
+
+    def bow_output_projection(args):
+      """linear(args, output_size, True) computed only for bow_ids.
+
+      Uses the same Linear/Matrix and Linear/Bias variables as linear, but
+      multiplies by the gathered bag columns only, applies bow_mask to them,
+      and scatters the logits back into a [batch x output_size] tensor that
+      is zero elsewhere.
+      """
+      if not bow_projection:
+        total_arg_size = sum(a.get_shape()[1].value for a in args)
+        with variable_scope.variable_scope("Linear"):
+          matrix = variable_scope.get_variable(
+              "Matrix", [total_arg_size, output_size], dtype=dtype)
+          bias = variable_scope.get_variable(
+              "Bias", [output_size], dtype=dtype,
+              initializer=tf.constant_initializer(0.0, dtype=dtype))
+        bow_projection["matrix"] = array_ops.gather(
+            array_ops.transpose(matrix), bow_ids)
+        bow_projection["bias"] = array_ops.gather(bias, bow_ids)
+        # bow_mask restricted to the bag columns; the same for every step.
+        bow_projection["mask"] = array_ops.transpose(array_ops.gather(
+            array_ops.transpose(bow_mask), bow_ids))
+      logits = math_ops.matmul(array_ops.concat(1, args),
+                               bow_projection["matrix"], transpose_b=True)
+      logits = nn_ops.bias_add(logits, bow_projection["bias"])
+      logits *= bow_projection["mask"]
+      output = array_ops.scatter_nd(
+          array_ops.expand_dims(bow_ids, 1), array_ops.transpose(logits),
+          array_ops.pack([output_size, array_ops.shape(logits)[0]]))
+      return array_ops.transpose(output)
+
+    step_linear = {}
+
+    def linear_variables(key, args, size, bias):
+      """Returns linear's (Matrix, Bias or None) for args, looked up once.
+
+      Creates (or reuses) the same Linear/Matrix and Linear/Bias variables as
+      linear in the current scope on the first call for key; later steps
+      reuse the cached variables instead of repeating the get_variable calls.
+      """
+      if key not in step_linear:
+        total_arg_size = sum(a.get_shape()[1].value for a in args)
+        with variable_scope.variable_scope("Linear"):
+          matrix = variable_scope.get_variable(
+              "Matrix", [total_arg_size, size], dtype=dtype)
+          bias_term = None
+          if bias:
+            bias_term = variable_scope.get_variable(
+                "Bias", [size], dtype=dtype,
+                initializer=tf.constant_initializer(0.0, dtype=dtype))
+        step_linear[key] = (matrix, bias_term)
+      return step_linear[key]
+
+    def cached_linear(key, args, size, bias):
+      """linear(args, size, bias) using the variables of linear_variables."""
+      matrix, bias_term = linear_variables(key, args, size, bias)
+      x = args[0] if len(args) == 1 else array_ops.concat(1, args)
+      if bias_term is None:
+        return math_ops.matmul(x, matrix)
+      return nn_ops.xw_plus_b(x, matrix, bias_term)
 
     if grammar is not None:
       logging.info('Constraining decoder to grammar')
@@ -1053,23 +1461,33 @@ def attention_decoder(decoder_inputs,
                  for _ in range(grammar.batch_size)]  
         logging.info('Initialising sampling-only stack')
     
-    for inp_idx, inp in enumerate(decoder_inputs):
-      if inp_idx > 0:
-        variable_scope.get_variable_scope().reuse_variables()
+    def step(inp_idx, inp, prev, state, attns, reuse_attention=False):
+      """Runs one decoder step and returns (output, state, attns).
+
+      inp_idx is a Python int in the unrolled loop and an int32 scalar Tensor
+      inside the while_loop.
+      """
       # If loop_function is set, we use it instead of decoder_inputs.
       if loop_function is not None and prev is not None:
         with variable_scope.variable_scope("loop_function", reuse=True):
-          inp = loop_function(prev, inp_idx)
+          if feed_previous_cond is None:
+            inp = loop_function(prev, inp_idx)
+          else:
+            given_inp = inp
+            inp = control_flow_ops.cond(
+                feed_previous_cond, lambda: loop_function(prev, inp_idx),
+                lambda: given_inp)
+            inp.set_shape(given_inp.get_shape())
       # Merge input and previous attentions into one vector of the right size.
       input_size = inp.get_shape().with_rank(2)[1]
       if input_size.value is None:
         raise ValueError("Could not infer input size from input: %s" % inp.name)
-      x = linear([inp] + attns, input_size, True)
+      x = cached_linear("Input", [inp] + attns, input_size.value, True)
       # Run the RNN.
       cell_output, state = cell(x, state) # run cell on combination of input and previous attn masks
 
       # Run the attention mechanism.
-      if inp_idx == 0 and initial_state_attention:
+      if reuse_attention:
         with variable_scope.variable_scope(variable_scope.get_variable_scope(),
                                            reuse=True):
           attns = attention(state) # calculate new attention masks (attention-weighted src vector)
@@ -1079,47 +1497,97 @@ def attention_decoder(decoder_inputs,
       if maxout_layer:
         # This tries to imitate the blocks Readout layer, consisting of Merge, Bias, Maxout, Linear, Linear
         # Merge: cell.output_size
+        merge_args = [cell_output] + [inp] + attns
         with tf.variable_scope("AttnMergeProjection"):
-          merge_output = linear([cell_output] + [inp] + attns, cell.output_size, True)
+          merge_matrix, merge_bias = linear_variables(
+              "AttnMergeProjection", merge_args, cell.output_size, True)
+        merge_output = math_ops.matmul(array_ops.concat(1, merge_args),
+                                       merge_matrix)
 
         # Bias
         b = tf.get_variable("maxout_b", [cell.output_size])
-        merge_output_plus_b = tf.nn.bias_add(merge_output, b)
 
         # Maxout: cell.output_size --> maxout_size
         maxout_size = cell.output_size // 2
-        segment_id_list = [ [m,m] for m in xrange(maxout_size) ] # make pairs of segment ids to be max-ed over
-        segment_id_list = list(chain(*segment_id_list)) # flatten list
-        segment_ids = tf.constant(segment_id_list, dtype=tf.int32)
-        maxout_output = tf.transpose(tf.segment_max(tf.transpose(merge_output_plus_b), segment_ids)) # transpose to get shape (cell.output_size, batch_size) and reverse
+        # max over pairs of adjacent units; the Merge and maxout biases are
+        # added inside the reduction instead of in separate passes
+        maxout_output = tf.reduce_max(
+            tf.reshape(merge_output, [-1, maxout_size, 2]) +
+            tf.reshape(merge_bias + b, [maxout_size, 2]), 2)
         maxout_output.set_shape([None, maxout_size])
 
         # Linear, softmax0 (maxout_size --> embedding_size ), without bias
         with tf.variable_scope("MaxoutOutputProjection_0"):
-          output_embed = linear([maxout_output], embedding_size, False)
+          output_embed = cached_linear("MaxoutOutputProjection_0",
+                                       [maxout_output], embedding_size, False)
 
         # Linear, softmax1 (embedding_size --> vocab_size), with bias
         with tf.variable_scope("MaxoutOutputProjection_1"):
-          output = linear([output_embed], output_size, True)
+          output = cached_linear("MaxoutOutputProjection_1",
+                                 [output_embed], output_size, True)
+      elif bow_mask is not None:
+        with variable_scope.variable_scope("AttnOutputProjection"):
+          output = bow_output_projection([cell_output] + attns)
+        output.set_shape([None, output_size])
       else:
         with variable_scope.variable_scope("AttnOutputProjection"):
-          output = linear([cell_output] + attns, output_size, True) # calculate the output
+          output = cached_linear("AttnOutputProjection",
+                                 [cell_output] + attns, output_size, True)
 
-      if bow_mask is not None:
+      if maxout_layer and bow_mask is not None:
         # Normalize output layer over subset of target words found in input bag-of-words.
         # To do this without changing the architecture, apply a mask over the output layer
         # that sets all logits for words outside the bag to zero.
+        # (bow_output_projection already applies the mask to its bag columns.)
         output = output * bow_mask
 
       if grammar is not None:
         output = apply_grammar(output, inp_idx, stack, grammar,
                                scope=variable_scope.get_variable_scope())
+      return output, state, attns
+
+    if use_while_loop and len(decoder_inputs) > 1:
+      # The first step creates the variables; the remaining steps reuse them
+      # as the body of a single while_loop.
+      output, state, attns = step(0, decoder_inputs[0], None, state, attns,
+                                  reuse_attention=initial_state_attention)
+      variable_scope.get_variable_scope().reuse_variables()
+      input_shape = decoder_inputs[0].get_shape()
+      input_ta = tensor_array_ops.TensorArray(
+          dtype=decoder_inputs[0].dtype, size=len(decoder_inputs)).unpack(
+              array_ops.pack(decoder_inputs))
+      output_ta = tensor_array_ops.TensorArray(
+          dtype=output.dtype, size=len(decoder_inputs)).write(0, output)
+
+      def _time_step(time, prev, state, attns, output_ta_t):
+        inp = input_ta.read(time)
+        inp.set_shape(input_shape)
+        output, state, attns = step(time, inp, prev, state, list(attns))
+        return (time + 1, output, state, attns, output_ta_t.write(time, output))
+
+      _, _, state, _, output_ta = control_flow_ops.while_loop(
+          cond=lambda time, *_: time < len(decoder_inputs),
+          body=_time_step,
+          loop_vars=(array_ops.constant(1, dtype=dtypes.int32), output, state,
+                     attns, output_ta),
+          swap_memory=swap_memory)
+      outputs = array_ops.unpack(output_ta.pack(), num=len(decoder_inputs))
+      for output in outputs:
+        output.set_shape([None, output_size])
+    else:
+      outputs = []
+      prev = None
+      for inp_idx, inp in enumerate(decoder_inputs):
+        if inp_idx > 0:
+          variable_scope.get_variable_scope().reuse_variables()
+        output, state, attns = step(
+            inp_idx, inp, prev, state, attns,
+            reuse_attention=(inp_idx == 0 and initial_state_attention))
+        if loop_function is not None:
+          prev = output
+        outputs.append(output)
 
-      if loop_function is not None:
-        prev = output
-      outputs.append(output)
-
-  logging.info("output size={}".format(output.get_shape()))
+  logging.info("output size={}".format(outputs[-1].get_shape()))
   return outputs, state
 
 
@@ -1142,7 +1610,9 @@ def embedding_attention_decoder(decoder_inputs,
                                 encoder="reverse",
                                 init_const=False,
                                 bow_mask=None,
-                                grammar=None):
+                                grammar=None,
+                                attention_type="additive",
+                                quantize_projection=False):
   """RNN decoder with embedding and attention and a pure-decoding option.
 
   Args:
@@ -1152,18 +1622,21 @@ def embedding_attention_decoder(decoder_inputs,
     cell: rnn_cell.RNNCell defining the cell function.
     num_symbols: Integer, how many symbols come into the embedding.
     embedding_size: Integer, the length of the embedding vector for each symbol.
+      The embedding is created on /cpu:0, whatever the enclosing device scope.
     num_heads: Number of attention heads that read from attention_states.
     output_size: Size of the output vectors; if None, use output_size.
     output_projection: None or a pair (W, B) of output projection weights and
       biases; W has shape [output_size x num_symbols] and B has shape
       [num_symbols]; if provided and feed_previous=True, each fed previous
       output will first be multiplied by W and added B.
-    feed_previous: Boolean; if True, only the first of decoder_inputs will be
-      used (the "GO" symbol), and all other decoder inputs will be generated by:
+    feed_previous: Boolean or scalar Boolean Tensor; if True, only the first
+      of decoder_inputs will be used (the "GO" symbol), and all other decoder
+      inputs will be generated by:
         next = embedding_lookup(embedding, argmax(previous_output)),
       In effect, this implements a greedy decoder. It can also be used
       during training to emulate http://arxiv.org/abs/1506.03099.
       If False, decoder_inputs are used as given (the standard decoder case).
+      A Tensor selects between the two at run time within a single decoder.
     update_embedding_for_previous: Boolean; if False and feed_previous=True,
       only the embedding for the first symbol of decoder_inputs (the "GO"
       symbol) will be updated by back propagation. Embeddings for the symbols
@@ -1176,6 +1649,10 @@ def embedding_attention_decoder(decoder_inputs,
       If True, initialize the attentions from the initial state and attention
       states -- useful when we wish to resume decoding from a previously
       stored decoder state and attention states.
+    attention_type: "additive" or "dot"; see attention_decoder.
+    quantize_projection: Boolean; if True and feed_previous is set, the fed
+      previous outputs are projected with an 8-bit quantized copy of W
+      (CPU only, no gradient); use it for inference-only decoding.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -1196,13 +1673,18 @@ def embedding_attention_decoder(decoder_inputs,
   with variable_scope.variable_scope(
       scope or "embedding_attention_decoder", dtype=dtype) as scope:
 
-    embedding = variable_scope.get_variable("embedding",
-                                            [num_symbols, embedding_size])
+    with ops.device("/cpu:0"):
+      embedding = variable_scope.get_variable("embedding",
+                                              [num_symbols, embedding_size])
+      emb_inp = array_ops.unpack(embedding_ops.embedding_lookup(
+          embedding, array_ops.pack(decoder_inputs)))
+    feed_previous_cond = None
+    if not isinstance(feed_previous, bool):
+      feed_previous_cond = feed_previous
     loop_function = _extract_argmax_and_embed(
         embedding, output_projection,
-        update_embedding_for_previous) if feed_previous else None
-    emb_inp = [
-        embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs]
+        update_embedding_for_previous, quantize_projection) if (
+            feed_previous_cond is not None or feed_previous) else None
     return attention_decoder(
         emb_inp,
         initial_state,
@@ -1218,7 +1700,9 @@ def embedding_attention_decoder(decoder_inputs,
         encoder=encoder,
         init_const=init_const,
         bow_mask=bow_mask,
-        grammar=grammar)
+        grammar=grammar,
+        attention_type=attention_type,
+        feed_previous_cond=feed_previous_cond)
 
 def embedding_attention_seq2seq(encoder_inputs,
                                 decoder_inputs,
@@ -1244,7 +1728,8 @@ def embedding_attention_seq2seq(encoder_inputs,
                                 keep_prob=1.0,
                                 initializer=None,
                                 legacy=False,
-                                grammar=None):
+                                grammar=None,
+                                quantize_projection=False):
   """Embedding sequence-to-sequence model with attention.
 
   This model first embeds encoder_inputs by a newly created embedding (of shape
@@ -1280,6 +1765,8 @@ def embedding_attention_seq2seq(encoder_inputs,
     initial_state_attention: If False (default), initial attentions are zero.
       If True, initialize the attentions from the initial state and attention
       states.
+    quantize_projection: Boolean; passed to embedding_attention_decoder to
+      project fed previous outputs with 8-bit weights when decoding greedily.
 
   Returns:
     A tuple of the form (outputs, state), where:
@@ -1322,14 +1809,11 @@ def embedding_attention_seq2seq(encoder_inputs,
                                                   bow_emb_size, encoder_inputs, dtype=dtype,
                                                   keep_prob=keep_prob, initializer=initializer)
 
-    # First calculate a concatenation of encoder outputs to put attention on.
-    if encoder == "bow":
-      top_states = [array_ops.reshape(e, [-1, 1, bow_emb_size])
-                  for e in encoder_outputs]
-    else:
-      top_states = [array_ops.reshape(e, [-1, 1, cell.output_size])
-                  for e in encoder_outputs]
-    attention_states = array_ops.concat(1, top_states)
+    # First stack the encoder outputs into the states to put attention on.
+    attention_states = array_ops.pack(encoder_outputs, axis=1)
+    attention_states.set_shape(
+        [None, len(encoder_outputs),
+         bow_emb_size if encoder == "bow" else cell.output_size])
 
     initial_state = encoder_state
     if encoder == "bidirectional" and init_backward:
@@ -1348,7 +1832,10 @@ def embedding_attention_seq2seq(encoder_inputs,
       #cell = rnn_cell.OutputProjectionWrapper(cell, num_decoder_symbols)
       output_size = num_decoder_symbols
 
-    if isinstance(feed_previous, bool):
+    # A feed_previous Tensor is handled inside a single decoder, which
+    # switches its inputs with a cond per step. The grammar stack depends on
+    # feed_previous at graph construction, so it still needs 2 graphs.
+    if isinstance(feed_previous, bool) or grammar is None:
       return embedding_attention_decoder(
           decoder_inputs,
           initial_state,
@@ -1360,15 +1847,20 @@ def embedding_attention_seq2seq(encoder_inputs,
           output_size=output_size,
           output_projection=output_projection,
           feed_previous=feed_previous,
+          update_embedding_for_previous=isinstance(feed_previous, bool),
           initial_state_attention=initial_state_attention,
           src_mask=src_mask,
           maxout_layer=maxout_layer,
           encoder=encoder,
           init_const=init_const,
           bow_mask=bow_mask,
-          grammar=grammar)
+          grammar=grammar,
+          quantize_projection=quantize_projection)
 
     # If feed_previous is a Tensor, we construct 2 graphs and use cond.
+    # Both decoders return a state shaped like encoder_state.
+    state_is_nested = nest.is_sequence(encoder_state)
+
     def decoder(feed_previous_bool):
       reuse = None if feed_previous_bool else True
       with variable_scope.variable_scope(
@@ -1391,10 +1883,9 @@ def embedding_attention_seq2seq(encoder_inputs,
             encoder=encoder,
             init_const=init_const,
             bow_mask=bow_mask,
-            grammar=grammar)
-        state_list = [state]
-        if nest.is_sequence(state):
-          state_list = nest.flatten(state)
+            grammar=grammar,
+            quantize_projection=quantize_projection)
+        state_list = nest.flatten(state) if state_is_nested else [state]
         return outputs + state_list
 
     outputs_and_state = control_flow_ops.cond(feed_previous,
@@ -1403,7 +1894,7 @@ def embedding_attention_seq2seq(encoder_inputs,
     outputs_len = len(decoder_inputs)  # Outputs length same as decoder inputs.
     state_list = outputs_and_state[outputs_len:]
     state = state_list[0]
-    if nest.is_sequence(encoder_state):
+    if state_is_nested:
       state = nest.pack_sequence_as(structure=encoder_state,
                                     flat_sequence=state_list)
     return outputs_and_state[:outputs_len], state
@@ -1481,44 +1972,70 @@ def one2many_rnn_seq2seq(encoder_inputs,
               decoder_inputs, encoder_state, decoder_cell, num_decoder_symbols,
               embedding_size, feed_previous=feed_previous)
         else:
-          # If feed_previous is a Tensor, we construct 2 graphs and use cond.
-          def filled_embedding_rnn_decoder(feed_previous):
-            """The current decoder with a fixed feed_previous parameter."""
-            # pylint: disable=cell-var-from-loop
-            reuse = None if feed_previous else True
-            vs = variable_scope.get_variable_scope()
-            with variable_scope.variable_scope(vs, reuse=reuse):
-              outputs, state = embedding_rnn_decoder(
-                  decoder_inputs, encoder_state, decoder_cell,
-                  num_decoder_symbols, embedding_size,
-                  feed_previous=feed_previous)
-            # pylint: enable=cell-var-from-loop
-            state_list = [state]
-            if nest.is_sequence(state):
-              state_list = nest.flatten(state)
-            return outputs + state_list
-
-          outputs_and_state = control_flow_ops.cond(
-              feed_previous,
-              lambda: filled_embedding_rnn_decoder(True),
-              lambda: filled_embedding_rnn_decoder(False))
-          # Outputs length is the same as for decoder inputs.
-          outputs_len = len(decoder_inputs)
-          outputs = outputs_and_state[:outputs_len]
-          state_list = outputs_and_state[outputs_len:]
-          state = state_list[0]
-          if nest.is_sequence(encoder_state):
-            state = nest.pack_sequence_as(structure=encoder_state,
-                                          flat_sequence=state_list)
+          # If feed_previous is a Tensor, build a single decoder whose steps
+          # feed the previous output with probability 1 or 0, rather than two
+          # decoders joined by a cond.
+          outputs, state = embedding_rnn_decoder(
+              decoder_inputs, encoder_state, decoder_cell, num_decoder_symbols,
+              embedding_size,
+              feed_prev_p=math_ops.cast(feed_previous, dtypes.float32))
       outputs_dict[name] = outputs
       state_dict[name] = state
 
   return outputs_dict, state_dict
 
 
+def _weighted_log_perps(logits, targets, weights, softmax_loss_function,
+                        num_samples=0, sampled_projection=None):
+  """Returns (summed weighted cross-entropy, summed weights) per example.
+
+  See sequence_loss_by_example for the arguments.
+
+  Raises:
+    ValueError: If only one of num_samples and sampled_projection is set, or
+      the number of classes in sampled_projection is not statically known.
+  """
+  if (num_samples > 0) != (sampled_projection is not None):
+    raise ValueError("num_samples and sampled_projection must be set "
+                     "together: %d, %s." % (num_samples, sampled_projection))
+  if sampled_projection is not None:
+    # One sampled softmax over all [T * batch] rows, sharing the sampled
+    # classes across time steps.
+    proj_w_t, proj_b = sampled_projection
+    num_classes = proj_w_t.get_shape().with_rank(2)[0].value
+    if num_classes is None:
+      raise ValueError("Shape[0] of the sampled_projection weights must be "
+                       "known: %s" % proj_w_t.get_shape())
+    crossent = tf.nn.sampled_softmax_loss(
+        proj_w_t, proj_b, array_ops.concat(0, logits),
+        array_ops.reshape(array_ops.pack(targets), [-1, 1]), num_samples,
+        num_classes)
+  elif softmax_loss_function is None:
+    # Score all time steps with a single softmax over the [T * batch]
+    # rows instead of one op per step.
+    # TODO(irving,ebrevdo): This reshape is needed because
+    # sequence_loss_by_example is called with scalars sometimes, which
+    # violates our general scalar strictness policy.
+    flat_targets = array_ops.reshape(array_ops.pack(targets), [-1])
+    crossent = nn_ops.sparse_softmax_cross_entropy_with_logits(
+        array_ops.concat(0, logits), flat_targets)
+  else:
+    crossent = array_ops.pack([softmax_loss_function(logit, target)
+                               for logit, target in zip(logits, targets)])
+  # Weight and sum all steps at once over [T x batch]; scalar weights
+  # become [T x 1] and broadcast as before.
+  weights_t = array_ops.reshape(array_ops.pack(weights), [len(logits), -1])
+  log_perps = math_ops.reduce_sum(
+      array_ops.reshape(crossent, [len(logits), -1]) * weights_t, [0])
+  total_size = math_ops.reduce_sum(weights_t, [0])
+  return log_perps, total_size
+
+
 def sequence_loss_by_example(logits, targets, weights,
                              average_across_timesteps=True,
-                             softmax_loss_function=None, name=None):
+                             softmax_loss_function=None, name=None,
+                             num_samples=0, sampled_projection=None,
+                             return_total_size=False):
   """Weighted cross-entropy loss for a sequence of logits (per example).
 
   Args:
@@ -1530,41 +2047,47 @@ def sequence_loss_by_example(logits, targets, weights,
     softmax_loss_function: Function (inputs-batch, labels-batch) -> loss-batch
       to be used instead of the standard softmax (the default if this is None).
     name: Optional name for this operation, default: "sequence_loss_by_example".
+    num_samples: Integer; if > 0, logits are the decoder outputs before the
+      projection and the loss is a sampled softmax over num_samples classes,
+      computed once for all time steps. Requires sampled_projection.
+    sampled_projection: None or a pair (W_t, B) of output projection weights
+      and biases; W_t has shape [num_decoder_symbols x output_size] (the
+      layout sampled_softmax_loss reads without a transpose), with
+      num_decoder_symbols statically known, and B has shape
+      [num_decoder_symbols]. Requires num_samples > 0.
+    return_total_size: If set, also return the total label weight of each
+      sequence, the divisor used by average_across_timesteps.
 
   Returns:
-    1D batch-sized float Tensor: The log-perplexity for each sequence.
+    1D batch-sized float Tensor: The log-perplexity for each sequence. If
+    return_total_size is set, a pair of it and the 1D batch-sized total label
+    weights (plus 1e-12 when averaging across timesteps).
 
   Raises:
-    ValueError: If len(logits) is different from len(targets) or len(weights).
+    ValueError: If len(logits) is different from len(targets) or len(weights),
+      or if only one of num_samples and sampled_projection is set.
   """
   if len(targets) != len(logits) or len(weights) != len(logits):
     raise ValueError("Lengths of logits, weights, and targets must be the same "
                      "%d, %d, %d." % (len(logits), len(weights), len(targets)))
   with ops.name_scope(name, "sequence_loss_by_example",
                       logits + targets + weights):
-    log_perp_list = []
-    for logit, target, weight in zip(logits, targets, weights):
-      if softmax_loss_function is None:
-        # TODO(irving,ebrevdo): This reshape is needed because
-        # sequence_loss_by_example is called with scalars sometimes, which
-        # violates our general scalar strictness policy.
-        target = array_ops.reshape(target, [-1])
-        crossent = nn_ops.sparse_softmax_cross_entropy_with_logits(
-            logit, target)
-      else:
-        crossent = softmax_loss_function(logit, target)
-      log_perp_list.append(crossent * weight)
-    log_perps = math_ops.add_n(log_perp_list)
+    log_perps, total_size = _weighted_log_perps(
+        logits, targets, weights, softmax_loss_function,
+        num_samples=num_samples, sampled_projection=sampled_projection)
     if average_across_timesteps:
-      total_size = math_ops.add_n(weights)
       total_size += 1e-12  # Just to avoid division by 0 for all-0 weights.
       log_perps /= total_size
+  if return_total_size:
+    return log_perps, total_size
   return log_perps
 
 
 def sequence_loss(logits, targets, weights,
                   average_across_timesteps=True, average_across_batch=True,
-                  softmax_loss_function=None, name=None):
+                  softmax_loss_function=None, name=None,
+                  num_samples=0, sampled_projection=None,
+                  return_total_size=False):
   """Weighted cross-entropy loss for a sequence of logits, batch-collapsed.
 
   Args:
@@ -1577,23 +2100,32 @@ def sequence_loss(logits, targets, weights,
     softmax_loss_function: Function (inputs-batch, labels-batch) -> loss-batch
       to be used instead of the standard softmax (the default if this is None).
     name: Optional name for this operation, defaults to "sequence_loss".
+    num_samples: See sequence_loss_by_example.
+    sampled_projection: See sequence_loss_by_example.
+    return_total_size: See sequence_loss_by_example.
 
   Returns:
     A scalar float Tensor: The average log-perplexity per symbol (weighted).
+    If return_total_size is set, a pair of it and the 1D batch-sized total
+    label weights, as returned by sequence_loss_by_example.
 
   Raises:
     ValueError: If len(logits) is different from len(targets) or len(weights).
   """
   with ops.name_scope(name, "sequence_loss", logits + targets + weights):
-    cost = math_ops.reduce_sum(sequence_loss_by_example(
+    log_perps, total_size = sequence_loss_by_example(
         logits, targets, weights,
         average_across_timesteps=average_across_timesteps,
-        softmax_loss_function=softmax_loss_function))
+        softmax_loss_function=softmax_loss_function,
+        num_samples=num_samples, sampled_projection=sampled_projection,
+        return_total_size=True)
+    cost = math_ops.reduce_sum(log_perps)
     if average_across_batch:
       batch_size = array_ops.shape(targets[0])[0]
-      return cost / math_ops.cast(batch_size, cost.dtype)
-    else:
-      return cost
+      cost /= math_ops.cast(batch_size, cost.dtype)
+  if return_total_size:
+    return cost, total_size
+  return cost
 
 
 def model_with_buckets_states(encoder_inputs, decoder_inputs, targets, weights,
@@ -1626,18 +2158,19 @@ def model_with_buckets_states(encoder_inputs, decoder_inputs, targets, weights,
                               feed_prev_p)
         outputs.append(seq2seq_out[0])
         states.append(seq2seq_out[1])
-        if per_example_loss:
-          losses.append(sequence_loss_by_example(
+        loss_function = (sequence_loss_by_example if per_example_loss
+                         else sequence_loss)
+        if len(seq2seq_out) == 3: # include KL loss
+          # The sequence loss and the KL term share one total label weight.
+          loss, total_size = loss_function(
               outputs[-1], targets[:bucket[1]], weights[:bucket[1]],
-              softmax_loss_function=softmax_loss_function))            
+              softmax_loss_function=softmax_loss_function,
+              return_total_size=True)
+          losses.append((loss, tf.reduce_mean(seq2seq_out[2] / total_size)))
         else:
-          losses.append(sequence_loss(
+          losses.append(loss_function(
               outputs[-1], targets[:bucket[1]], weights[:bucket[1]],
               softmax_loss_function=softmax_loss_function))
-        if len(seq2seq_out) == 3: # include KL loss
-          kl_obj = seq2seq_out[2]
-          total_size = math_ops.add_n(weights[:bucket[1]]) + 1e-12  # avoid division by 0
-          losses[-1] = (losses[-1], tf.reduce_mean(kl_obj / total_size))
   return outputs, losses, states
 
 def model_with_buckets(encoder_inputs, decoder_inputs, targets, weights,